@@ -1,9 +1,12 @@
 import json
 import logging
+import threading
+import concurrent.futures
 import pandas as pd
 
 from oauthlib.oauth2 import BackendApplicationClient
 from requests_oauthlib import OAuth2Session
+from barbell2_castor.schema import StudySchemaPlan, convert_field_value
 from barbell2_castor.utils import current_time_secs, elapsed_secs, duration
 
 logger = logging.getLogger('__name__')
@@ -15,10 +18,18 @@ class CastorApiClient:
     token_url = base_url + '/oauth/token'
     api_url = base_url + '/api'
 
-    def __init__(self, client_id, client_secret, verbose=False):
+    # Above this number of records a single export/data download is cheaper than
+    # one data-points request per record
+    bulk_export_threshold = 50
+    bulk_max_workers = 8
+
+    def __init__(self, client_id, client_secret, verbose=False, cache_dir=None):
+        # cache_dir is where schema plans are cached, False disables the cache (see
+        # StudySchemaPlan)
         self.verbose = verbose
         if self.verbose:
             logger.info(f'__init__()')
+        self.cache_dir = cache_dir
         self.client_id = client_id
         self.client_secret = client_secret
         self.session = self.create_session(self.client_id, self.client_secret)
@@ -85,9 +96,13 @@ class CastorApiClient:
                         print(record)
         return records
     
-    def get_record_field_data(self, study_id, record_id):
+    def get_record_field_data(self, study_id, record_id, session=None):
+        if session is None:
+            session = self.session
         record_url = self.api_url + '/study/{}/participant/{}/data-points/study'.format(study_id, record_id)
-        response = self.session.get(record_url)
+        response = session.get(record_url)
+        # Rate limiting (429) and expired tokens (401) are likely with several workers
+        response.raise_for_status()
         record_field_data = response.json()
         return record_field_data['_embedded']['items']
 
@@ -137,79 +152,125 @@ class CastorApiClient:
             return response_data['value']
         return None
     
-    def get_study_data(self, study_id):
+    @staticmethod
+    def convert_field_value(field_type, value):
+        return convert_field_value(field_type, value)
+
+    def get_study_schema_plan(self, study_id, cache_dir=None):
+        if cache_dir is None:
+            cache_dir = self.cache_dir
         logger.info('getting study structure...')
         study_structure_url = self.api_url + '/study/{}/export/structure'.format(study_id)
-        response = self.session.get(study_structure_url)
-        field_defs = {}
-        for line in response.text.split('\n')[1:]:
-            items = line.split(';')
-            if len(items) == 16:
-                field_type = items[11]
-                if field_type != 'calculation' and field_type != 'remark':
-                    field_id = items[8]
-                    field_name = items[9]
-                    field_option_group = items[15]
-                    field_defs[field_id] = [field_name, field_type, field_option_group]
-        logger.info('getting study data...')
+        structure_text = self.session.get(study_structure_url).text
+        logger.info('getting study option groups...')
+        study_optiongroups_url = self.api_url + '/study/{}/export/optiongroups'.format(study_id)
+        optiongroups_text = self.session.get(study_optiongroups_url).text
+        return StudySchemaPlan.from_exports(structure_text, optiongroups_text, cache_dir)
+
+    def get_study_structure(self, study_id, fields=None):
+        plan = self.get_study_schema_plan(study_id).select(fields)
+        return plan.get_field_defs()
+
+    def get_field_values_from_export(self, study_id, record_ids, field_ids):
         study_data_url = self.api_url + '/study/{}/export/data'.format(study_id)
         response = self.session.get(study_data_url)
-        records = {}
+        response.raise_for_status()
+        record_ids = set(record_ids)
+        values = {}
         for line in response.text.split('\n')[1:]:
             items = line.split(';')
-            if len(items) == 9:
+            if len(items) == 9 and items[2] == 'Study':
                 record_id = items[1]
-                form_type = items[2]
-                if form_type == '':
-                    records[record_id] = {}
-                elif form_type == 'Study':
-                    field_id = items[5]
-                    field_value = items[6]
-                    records[record_id][field_id] = field_value
-        logger.info('getting study option groups...')
-        study_optiongroups_url = self.api_url + '/study/{}/export/optiongroups'.format(study_id)
-        response = self.session.get(study_optiongroups_url)
-        option_groups = {}
-        for line in response.text.split('\n')[1:]:
-            items = line.split(';')
-            if len(items) == 6:
-                option_group_id = items[1]
-                if option_group_id not in option_groups.keys():
-                    option_groups[option_group_id] = {}
-                option_groups[option_group_id][items[5]] = items[4]  # name, value
-        logger.info('building study data...')
-        data = {}
-        # Initialize study data
-        # Iterate through all field definitions. For each, create a key in data. However,
-        # if the field is an option group, create additional keys in data, one for each 
-        # option value.
-        for field_id in field_defs.keys():
-            field_name = field_defs[field_id][0]
-            field_type = field_defs[field_id][1]
-            field_option_group_id = field_defs[field_id][2]
-            field_options = None
-            if field_option_group_id != '':
-                field_options = option_groups[field_option_group_id]
-            data[field_name] = {
-                'field_type': field_type,
-                # 'field_option_group': field_option_group_id,
-                'field_options': field_options,
-                'field_values': [],
-            }
-        for field_id in field_defs.keys():
-            field_name = field_defs[field_id][0]
-            field_type = field_defs[field_id][1]
-            for record_id in list(records.keys()):
-                # We know field_name is one of the keys in data. We just need to check
-                # whether records has an entry for this field (with a value). If not, we
-                # assign empty string
-                data[field_name]['field_type'] = field_type
-                if field_id in records[record_id].keys():
-                    data[field_name]['field_values'].append(records[record_id][field_id])
-                else:
-                    data[field_name]['field_values'].append('')
+                field_id = items[5]
+                if record_id in record_ids and field_id in field_ids:
+                    values.setdefault(record_id, {})[field_id] = items[6]
+        return values
 
-        return data
+    def create_worker_session(self):
+        # Sessions are not guaranteed to be thread-safe, so each worker thread gets its
+        # own session that reuses the access token of the main session
+        client = BackendApplicationClient(client_id=self.client_id)
+        return OAuth2Session(client=client, token=self.session.token)
+
+    def get_field_values_from_data_points(self, study_id, record_ids, field_ids, max_workers):
+        local = threading.local()
+        sessions = []
+        sessions_lock = threading.Lock()
+        def get_values(record_id):
+            if not hasattr(local, 'session'):
+                local.session = self.create_worker_session()
+                with sessions_lock:
+                    sessions.append(local.session)
+            record_values = {}
+            for item in self.get_record_field_data(study_id, record_id, local.session):
+                if item['field_id'] in field_ids:
+                    record_values[item['field_id']] = item['field_value']
+            return record_id, record_values
+        values = {}
+        try:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+                for record_id, record_values in executor.map(get_values, record_ids):
+                    values[record_id] = record_values
+        finally:
+            for session in sessions:
+                session.close()
+        return values
+
+    def get_field_values(self, study_id, records, field_names, max_workers=None, export_threshold=None):
+        # Returns a DataFrame with one row per record and one typed column per field. Replaces
+        # calling get_field_value() for each record and field separately
+        if max_workers is None:
+            max_workers = self.bulk_max_workers
+        if export_threshold is None:
+            export_threshold = self.bulk_export_threshold
+        record_ids = [self.get_record_id(record) if isinstance(record, dict) else record for record in records]
+        field_names = list(field_names)
+        plan = self.get_study_schema_plan(study_id)
+        for field_name in field_names:
+            if field_name not in plan.field_types.keys():
+                raise RuntimeError(f'Unknown field: {field_name}')
+        field_ids = {}
+        for field_id, field_name in plan.get_field_ids().items():
+            if field_name in field_names:
+                field_ids[field_id] = field_name
+        if len(record_ids) > export_threshold:
+            logger.info(f'getting values for {len(record_ids)} records from export...')
+            values = self.get_field_values_from_export(study_id, record_ids, field_ids)
+        else:
+            logger.info(f'getting values for {len(record_ids)} records from data points...')
+            values = self.get_field_values_from_data_points(study_id, record_ids, field_ids, max_workers)
+        matrix = {}
+        for field_name in field_names:
+            matrix[field_name] = []
+        for record_id in record_ids:
+            record_values = values.get(record_id, {})
+            for field_id, field_name in field_ids.items():
+                matrix[field_name].append(plan.convert(field_name, record_values.get(field_id)))
+        return pd.DataFrame(data=matrix, index=pd.Index(record_ids, name='record_id'), columns=field_names)
+
+    def iter_study_data_lines(self, study_id, chunk_size=65536):
+        # Streams export/data line by line (without header) instead of loading the whole
+        # export into memory
+        study_data_url = self.api_url + '/study/{}/export/data'.format(study_id)
+        response = self.session.get(study_data_url, stream=True)
+        response.raise_for_status()
+        if response.encoding is None:
+            response.encoding = 'utf-8'
+        header = True
+        # Without a delimiter iter_lines() also splits on characters such as \r and \u2028,
+        # which can occur in textarea values
+        for line in response.iter_lines(chunk_size=chunk_size, decode_unicode=True, delimiter='\n'):
+            if header:
+                header = False
+                continue
+            yield line
+
+    def get_study_data(self, study_id, fields=None, plan=None):
+        if plan is None:
+            plan = self.get_study_schema_plan(study_id)
+        plan = plan.select(fields)
+        logger.info('getting study data...')
+        return plan.build_study_data(self.iter_study_data_lines(study_id))
     
     def get_study_data_old(self, study_id):
         logger.info('getting study structure...')
@@ -0,0 +1,201 @@
+import time
+import asyncio
+import logging
+
+# Requires the optional aiohttp package (pip install barbell2_castor[async])
+import aiohttp
+
+from barbell2_castor.schema import StudySchemaPlan
+
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncCastorApiClient:
+
+    default_base_url = 'https://data.castoredc.com'
+
+    # Refresh the access token this many seconds before it expires
+    token_expiry_margin = 60
+
+    def __init__(
+            self,
+            client_id,
+            client_secret,
+            base_url=None,
+            max_connections=16,
+            max_concurrency=8,
+            semaphore=None,
+            verbose=False,
+            cache_dir=None,
+            ):
+        # base_url can point to a local stand-in server for testing. Pass the same
+        # semaphore to several clients to share a single concurrency limit. cache_dir is
+        # where schema plans are cached, False disables the cache (see StudySchemaPlan)
+        self.client_id = client_id
+        self.client_secret = client_secret
+        self.base_url = base_url or self.default_base_url
+        self.token_url = self.base_url + '/oauth/token'
+        self.api_url = self.base_url + '/api'
+        self.max_connections = max_connections
+        self.semaphore = semaphore or asyncio.Semaphore(max_concurrency)
+        self.verbose = verbose
+        self.cache_dir = cache_dir
+        self.session = None
+        self.access_token = None
+        self.token_expires_at = 0
+        self.token_lock = asyncio.Lock()
+        self.studies = []
+
+    async def __aenter__(self):
+        await self.open()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.close()
+
+    async def open(self):
+        connector = aiohttp.TCPConnector(limit=self.max_connections)
+        self.session = aiohttp.ClientSession(connector=connector)
+        self.studies = await self.get_studies()
+        return self
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+
+    async def fetch_token(self):
+        async with self.session.post(self.token_url, data={
+                'grant_type': 'client_credentials',
+                'client_id': self.client_id,
+                'client_secret': self.client_secret,
+                }) as response:
+            response.raise_for_status()
+            token = await response.json(content_type=None)
+        self.access_token = token['access_token']
+        self.token_expires_at = time.monotonic() + float(token.get('expires_in', 3600))
+        if self.verbose:
+            logger.info(f'fetch_token() expires_in={token.get("expires_in")}')
+
+    async def get_access_token(self, rejected_token=None):
+        # Fetches a new token when the current one expires or was rejected by the server.
+        # Only one coroutine fetches it, the others wait for it. A coroutine whose token
+        # was rejected after another one already replaced it uses the new token
+        async with self.token_lock:
+            if rejected_token is not None and self.access_token != rejected_token:
+                return self.access_token
+            if rejected_token is not None or self.access_token is None or time.monotonic() > self.token_expires_at - self.token_expiry_margin:
+                await self.fetch_token()
+            return self.access_token
+
+    async def open_response(self, uri):
+        # Sends the request, fetching a new token once if the current one is rejected.
+        # The caller reads and releases the response
+        token = await self.get_access_token()
+        for attempt in range(2):
+            response = await self.session.get(uri, headers={'Authorization': f'Bearer {token}'})
+            if response.status == 401 and attempt == 0:
+                response.release()
+                token = await self.get_access_token(rejected_token=token)
+                continue
+            response.raise_for_status()
+            return response
+
+    async def get(self, uri, as_json=True):
+        async with self.semaphore:
+            response = await self.open_response(uri)
+            try:
+                if as_json:
+                    return await response.json(content_type=None)
+                return await response.text()
+            finally:
+                response.release()
+
+    async def get_pages(self, uri, key):
+        # Fetches the first page to get the page count, then the others concurrently
+        response_data = await self.get(uri)
+        pages = [response_data]
+        page_count = response_data['page_count']
+        if page_count > 1:
+            pages += await asyncio.gather(*[self.get(f'{uri}?page={i}') for i in range(2, page_count + 1)])
+        items = []
+        for page in pages:
+            items += page['_embedded'][key]
+        return items
+
+    async def get_studies(self):
+        uri = self.api_url + '/study'
+        response_data = await self.get(uri)
+        studies = []
+        for study in response_data['_embedded']['study']:
+            studies.append(study)
+        return studies
+
+    def get_study(self, name):
+        for study in self.studies:
+            if study['name'] == name:
+                return study
+        return None
+
+    @staticmethod
+    def get_study_id(study):
+        return study['study_id']
+
+    async def get_records(self, study_id):
+        records = []
+        for record in await self.get_pages(self.api_url + '/study/{}/record'.format(study_id), 'records'):
+            if not record['id'].startswith('ARCHIVED'):
+                records.append(record)
+        return records
+
+    async def get_record_field_data(self, study_id, record_id):
+        record_url = self.api_url + '/study/{}/participant/{}/data-points/study'.format(study_id, record_id)
+        record_field_data = await self.get(record_url)
+        return record_field_data['_embedded']['items']
+
+    async def get_fields(self, study_id):
+        return await self.get_pages(self.api_url + '/study/{}/field'.format(study_id), 'fields')
+
+    async def get_study_schema_plan(self, study_id, cache_dir=None):
+        if cache_dir is None:
+            cache_dir = self.cache_dir
+        logger.info('getting study structure and option groups...')
+        structure_text, optiongroups_text = await asyncio.gather(
+            self.get(self.api_url + '/study/{}/export/structure'.format(study_id), as_json=False),
+            self.get(self.api_url + '/study/{}/export/optiongroups'.format(study_id), as_json=False),
+        )
+        return StudySchemaPlan.from_exports(structure_text, optiongroups_text, cache_dir)
+
+    async def iter_study_data_lines(self, study_id, chunk_size=65536):
+        # Streams export/data line by line (without header) instead of loading the whole
+        # export into memory. Lines are split on \n only, as in CastorApiClient
+        async with self.semaphore:
+            response = await self.open_response(self.api_url + '/study/{}/export/data'.format(study_id))
+            try:
+                encoding = response.get_encoding()
+                header = True
+                pending = b''
+                async for chunk in response.content.iter_chunked(chunk_size):
+                    lines = (pending + chunk).split(b'\n')
+                    pending = lines.pop()
+                    for line in lines:
+                        if header:
+                            header = False
+                            continue
+                        yield line.decode(encoding)
+                if len(pending) > 0 and not header:
+                    yield pending.decode(encoding)
+            finally:
+                response.release()
+
+    async def get_study_data(self, study_id, fields=None, plan=None):
+        if plan is None:
+            plan = await self.get_study_schema_plan(study_id)
+        plan = plan.select(fields)
+        logger.info('getting study data...')
+        field_ids = plan.get_data_field_ids()
+        records = {}
+        async for line in self.iter_study_data_lines(study_id):
+            plan.add_study_data_line(records, field_ids, line)
+        return plan.create_study_data(records)
@@ -3,6 +3,8 @@ import json
 import pandas as pd
 
 from barbell2_castor.api import CastorApiClient
+from barbell2_castor.schema import StudySchemaPlan, RECORD_ID_COLUMN, check_field_name
+from barbell2_castor.selection import FieldSelection, select_fields
 
 
 """ -------------------------------------------------------------------------------------------
@@ -23,22 +25,47 @@ class CastorToDict:
 """
 class CastorApiToDict(CastorToDict):
     
-    def __init__(self, study_name, client_id, client_secret):
-        self.client = CastorApiClient(client_id, client_secret)
+    def __init__(self, study_name, client_id, client_secret, fields=None, cache_dir=None):
+        self.client = CastorApiClient(client_id, client_secret, cache_dir=cache_dir)
         self.study_id = self.client.get_study_id(self.client.get_study(study_name))
+        self.fields = fields
     
     def execute(self):
-        return self.client.get_study_data(self.study_id)
+        return self.client.get_study_data(self.study_id, self.fields)
 
 
 """ -------------------------------------------------------------------------------------------
 """
 class CastorExcelToDict(CastorToDict):
 
-    def __init__(self, excel_file):
+    def __init__(self, excel_file, fields=None, plan=None):
+        # plan is a schema plan or the key of a cached one
         self.excel_file = excel_file
+        self.selection = FieldSelection.create(fields)
+        self.plan = StudySchemaPlan.create(plan)
         
     def execute(self):
+        if self.plan is None:
+            data = self.load_definitions()
+        else:
+            # a cached schema plan replaces reading the option and variable sheets
+            data = self.plan.with_record_id().select(self.selection).create_data()
+        self.load_data(data)
+        if len(data[RECORD_ID_COLUMN]['field_values']) == 0:
+            del data[RECORD_ID_COLUMN]
+        
+        # check that field_value arrays are all the same length
+        required_length = 0
+        for column in data.keys():
+            length = len(data[column]['field_values'])
+            if required_length == 0:
+                required_length = length
+            if length != required_length:
+                raise RuntimeError(f'Length for column {column} is not correct, should be {required_length} but is {length}')            
+
+        return data
+
+    def load_definitions(self):
         
         # load options
         df_opts = pd.read_excel(self.excel_file, sheet_name='Field options')
@@ -57,20 +84,42 @@ class CastorExcelToDict(CastorToDict):
             if field_type in CastorToDict.FIELD_TYPES_TO_SKIP:
                 continue
             field_name = row['Variable name']
+            check_field_name(field_name)
+            form_name = row.get('Form name', row.get('Step name'))
+            phase_name = row.get('Phase name', row.get('Visit name'))
+            if self.selection is not None and not self.selection.matches(field_name, form_name, phase_name):
+                continue
             data[field_name] = {
                 'field_type': field_type,
                 'field_options': None,
+                'form_name': form_name if isinstance(form_name, str) else None,
+                'phase_name': phase_name if isinstance(phase_name, str) else None,
                 'field_values': [],
             }
             if field_type == 'radio' or field_type == 'dropdown':
                 data[field_name]['field_options'] = option_groups[row['Optiongroup name']]
             else:
                 pass
-        
-        # load data
-        df_data = pd.read_excel(self.excel_file, sheet_name='Study results')
+        if self.selection is not None:
+            self.selection.check_selected(data)
+        record_id = {
+            'field_type': 'string',
+            'field_options': None,
+            'form_name': None,
+            'phase_name': None,
+            'field_values': [],
+        }
+        return {RECORD_ID_COLUMN: record_id, **data}
+
+    def load_data(self, data):
+        # only parse the columns of (selected) fields and the participant ID
+        df_data = pd.read_excel(
+            self.excel_file, sheet_name='Study results', usecols=lambda column: column in data.keys() or column == 'Participant Id')
         for _, row in df_data.iterrows():
             for field_name in row.keys():
+                if field_name == 'Participant Id':
+                    data[RECORD_ID_COLUMN]['field_values'].append(str(row[field_name]))
+                    continue
                 if field_name in CastorToDict.COLUMNS_TO_SKIP or field_name.endswith('_calc'):
                     continue
                 field_value = str(row[field_name])
@@ -93,51 +142,32 @@ class CastorExcelToDict(CastorToDict):
                             raise RuntimeError(f'Unknown field type: {field_type}')
                     except:
                         print()
-                
-        # check that field_value arrays are all the same length
-        required_length = 0
-        for column in data.keys():
-            length = len(data[column]['field_values'])
-            if required_length == 0:
-                required_length = length
-            if length != required_length:
-                raise RuntimeError(f'Length for column {column} is not correct, should be {required_length} but is {length}')            
-
         return data
     
     
 class CastorDictToDataFrame:
     
-    def __init__(self, data):
-        self.data = data
+    def __init__(self, data, fields=None, plan=None):
+        if plan is None:
+            self.data = select_fields(data, fields, always=[RECORD_ID_COLUMN])
+            self.plan = StudySchemaPlan.from_data(self.data)
+        else:
+            self.plan = StudySchemaPlan.create(plan).select(fields)
+            if RECORD_ID_COLUMN in data.keys():
+                self.plan = self.plan.with_record_id()
+            self.data = {}
+            for field_name in self.plan.field_names:
+                self.data[field_name] = data[field_name]
     
     def execute(self):
         data = {}
-        # create table columns by expanding option group with one-hot encoding
-        for field_name in self.data.keys():
-            field_type = self.data[field_name]['field_type']
-            if field_type == 'radio' or field_type == 'dropdown':
-                field_options = self.data[field_name]['field_options']
-                for option_value in field_options.keys():
-                    k = f'{field_name}${option_value}'
-                    data[k] = []
-            else:
-                data[field_name] = []
-        # add values to columns
-        for field_name in self.data.keys():
-            field_type = self.data[field_name]['field_type']
-            if field_type == 'radio' or field_type == 'dropdown':
-                field_options = self.data[field_name]['field_options']
-                for value in self.data[field_name]['field_values']:
-                    for option_value in field_options.keys():
-                        k = f'{field_name}${option_value}'
-                        if option_value == value:
-                            data[k].append('1')
-                        else:
-                            data[k].append('0')
+        # option groups are expanded with one-hot encoding as listed in the schema plan
+        for column_name, field_name, option_value in self.plan.expanded_columns:
+            field_values = self.data[field_name]['field_values']
+            if option_value is None:
+                data[column_name] = list(field_values)
             else:
-                for value in self.data[field_name]['field_values']:
-                    data[field_name].append(value)
+                data[column_name] = ['1' if value == option_value else '0' for value in field_values]
         return pd.DataFrame(data=data)
         
 
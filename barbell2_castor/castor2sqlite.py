@@ -7,6 +7,12 @@ import sqlite3
 # from pysqlite3 import dbapi2 as sqlite3
 from datetime import datetime
 from barbell2_castor.api import CastorApiClient
+from barbell2_castor.history import ExportHistory
+from barbell2_castor.materialize import MaterializedViews
+from barbell2_castor.pipeline import StudyDataPipeline
+from barbell2_castor.schema import StudySchemaPlan, CASTOR_TO_SQL_TYPES, RECORD_ID_COLUMN, convert_field_value
+from barbell2_castor.selection import select_fields
+from barbell2_castor.stats import ColumnStatistics
 
 
 logging.basicConfig()
@@ -21,19 +27,28 @@ class CastorToDict:
             client_id, 
             client_secret, 
             log_level=logging.INFO, 
+            fields=None,
+            cache_dir=None,
             ):
         self.study_name = study_name
         self.client_id = client_id
         self.client_secret = client_secret
         self.log_level = log_level
+        self.fields = fields
+        self.cache_dir = cache_dir
         logging.root.setLevel(self.log_level)
         self.data = {}
+        self.plan = None
+
+    def create_client(self):
+        return CastorApiClient(self.client_id, self.client_secret, cache_dir=self.cache_dir)
 
     def execute(self):
-        client = CastorApiClient(self.client_id, self.client_secret)
+        client = self.create_client()
         study = client.get_study(self.study_name)
         study_id = client.get_study_id(study)
-        self.data = client.get_study_data(study_id)
+        self.plan = client.get_study_schema_plan(study_id).select(self.fields)
+        self.data = client.get_study_data(study_id, plan=self.plan)
         return self.data
 
 
@@ -48,15 +63,7 @@ class CastorExcelToDict:
 
 class DictToSqlite3:
 
-    CASTOR_TO_SQL_TYPES = {
-        'string': 'TEXT',
-        'textarea': 'TEXT',
-        'radio': 'TINYINT',
-        'dropdown': 'TINYINT',
-        'numeric': 'FLOAT',
-        'date': 'DATE',
-        'year': 'TINYINT',
-    }
+    CASTOR_TO_SQL_TYPES = CASTOR_TO_SQL_TYPES
 
     def __init__(
             self, 
@@ -64,68 +71,74 @@ class DictToSqlite3:
             output_db_file='castor.db', 
             add_timestamp=False,
             log_level=logging.INFO, 
+            fields=None,
+            plan=None,
+            materialize=None,
+            column_stats=True,
+            history=None,
+            history_key_field=None,
             ):
-        self.data = data
-        self.output_db_file = output_db_file
-        if add_timestamp:
-            items = os.path.splitext(self.output_db_file)
-            timestamp = datetime.now().strftime('%Y%m%d%H%M%S')
-            self.output_db_file = f'{items[0]}-{timestamp}{items[1]}'
+        self.materialized_views = MaterializedViews.create(materialize)
+        self.column_stats = column_stats
+        self.history = history
+        self.history_key_field = history_key_field
+        if plan is None:
+            self.data = select_fields(data, fields, always=[RECORD_ID_COLUMN])
+            self.plan = StudySchemaPlan.from_data(self.data)
+        else:
+            self.plan = StudySchemaPlan.create(plan).select(fields)
+            if RECORD_ID_COLUMN in data.keys():
+                self.plan = self.plan.with_record_id()
+            self.data = {}
+            for field_name in self.plan.field_names:
+                self.data[field_name] = data[field_name]
+        self.output_db_file = self.get_output_db_file(output_db_file, add_timestamp)
         self.log_level = log_level
         logging.root.setLevel(self.log_level)
 
     @staticmethod
-    def get_sql_object_for_field_data(field_data, i):
-        value = field_data['field_values'][i]
-        if (field_data['field_type'] == 'radio' or field_data['field_type'] == 'dropdown' or field_data['field_type'] == 'year') and value != '':
-            try:
-                return int(value)
-            except ValueError:
-                print('ValueError (int): name={}, value={}'.format(field_data['field_variable_name'], value))
-        if field_data['field_type'] == 'numeric' and value != '':
-            try:                
-                return float(value)
-            except ValueError:
-                print('ValueError (float): name={}, value={}'.format(field_data['field_variable_name'], value))
-        if field_data['field_type'] == 'date' and value != '':
-            try:
-                return datetime.strptime(value, '%d-%m-%Y').date()
-            except ValueError:
-                print('ValueError (date): name={}, value={}'.format(field_data['field_variable_name'], value))
-        return str(field_data['field_values'][i])
+    def add_to_history(history, history_key_field, db_file):
+        # Records an export in an ExportHistory, or in the history file it points to
+        export_history = ExportHistory.create(history, history_key_field)
+        try:
+            return export_history.add_database(db_file, exported_at=datetime.now())
+        finally:
+            if export_history is not history:
+                export_history.close()
 
-    def generate_list_of_sql_statements_for_inserting_records(self, data):
-        nr_records = len(data[list(data.keys())[0]]['field_values'])
+    @staticmethod
+    def get_output_db_file(output_db_file, add_timestamp):
+        if add_timestamp:
+            items = os.path.splitext(output_db_file)
+            timestamp = datetime.now().strftime('%Y%m%d%H%M%S')
+            return f'{items[0]}-{timestamp}{items[1]}'
+        return output_db_file
+
+    def generate_rows(self, data):
+        nr_records = 0
+        if len(data.keys()) > 0:
+            nr_records = len(data[self.plan.field_names[0]]['field_values'])
         logger.info(f'nr. records: {nr_records}')
-        placeholders = []
-        values = []
         for i in range(nr_records):
-            placeholder = 'INSERT INTO data ('
-            value = []
-            for field_name in data.keys():
-                placeholder += field_name + ', '
-            placeholder = placeholder[:-2] + ') VALUES ('
-            for field_name in data.keys():
-                value.append(self.get_sql_object_for_field_data(data[field_name], i))
-                placeholder += '?, '
-            placeholder = placeholder[:-2] + ');'
-            placeholders.append(placeholder)
-            values.append(value)
-        return placeholders, values
-    
+            values = []
+            for field_name in self.plan.field_names:
+                values.append(data[field_name]['field_values'][i])
+            yield self.plan.convert_row(values)
+
+    @staticmethod
+    def get_sql_object_for_field_data(field_data, i):
+        return convert_field_value(field_data['field_type'], field_data['field_values'][i], empty='')
+
+    def generate_list_of_sql_statements_for_inserting_records(self, data):
+        values = list(self.generate_rows(data))
+        return [self.plan.insert_sql] * len(values), values
+
     def generate_sql_field_from_field_type_and_field_name(self, field_type, field_name):
-        return '{} {}'.format(field_name, DictToSqlite3.CASTOR_TO_SQL_TYPES[field_type])
+        return '{} {}'.format(field_name, CASTOR_TO_SQL_TYPES.get(field_type, 'TEXT'))
 
     def generate_sql_for_creating_table(self, data):
         logger.info(f'nr. columns: {len(data.keys())}')
-        sql = 'CREATE TABLE data (id INTEGER PRIMARY KEY, '
-        for field_name in data.keys():
-            field_type = data[field_name]['field_type']
-            field_type_sql = self.generate_sql_field_from_field_type_and_field_name(field_type, field_name)
-            if field_type_sql is not None:
-                sql += field_type_sql + ', '
-        sql = sql[:-2] + ');'
-        return sql
+        return StudySchemaPlan.from_data(data).create_table_sql
 
     @staticmethod
     def generate_sql_for_dropping_table():
@@ -136,20 +149,39 @@ class DictToSqlite3:
         try:
             conn = sqlite3.connect(self.output_db_file)
             cursor = conn.cursor()
+            MaterializedViews.invalidate(conn)
             cursor.execute(self.generate_sql_for_dropping_table())
-            cursor.execute(self.generate_sql_for_creating_table(data))
-            placeholders, values = self.generate_list_of_sql_statements_for_inserting_records(data)
-            for i in range(len(placeholders)):
-                cursor.execute(placeholders[i], values[i])
+            logger.info(f'nr. columns: {len(self.plan.field_names)}')
+            cursor.execute(self.plan.create_table_sql)
+            rows = self.generate_rows(data)
+            stats = None
+            if self.column_stats:
+                stats = ColumnStatistics(self.plan)
+                rows = stats.track(rows)
+            cursor.executemany(self.plan.insert_sql, rows)
             conn.commit()
+            if stats is not None:
+                stats.write(conn)
+                stats.save(self.output_db_file + '.stats.json')
+            else:
+                ColumnStatistics.invalidate(conn, self.output_db_file + '.stats.json')
+                conn.commit()
+            if self.materialized_views is not None:
+                self.materialized_views.execute(conn)
+            return True
         except sqlite3.Error as e:
             logger.error(e)
         finally:
             if conn:
                 conn.close()
+        return False
 
     def execute(self):
-        self.create_sql_database(self.data)
+        if self.create_sql_database(self.data):
+            if self.history is not None:
+                self.add_to_history(self.history, self.history_key_field, self.output_db_file)
+        else:
+            logger.error(f'export to {self.output_db_file} failed, not added to history')
         return self.output_db_file
     
 
@@ -163,18 +195,53 @@ class CastorToSqlite3:
             output_db_file='castor.db',
             add_timestamp=False,
             log_level=logging.INFO, 
+            fields=None,
+            pipelined=False,
+            batch_size=500,
+            materialize=None,
+            column_stats=True,
+            history=None,
+            history_key_field=None,
+            cache_dir=None,
             ):
-        self.castor2dict = CastorToDict(study_name, client_id, client_secret, log_level)        
+        self.castor2dict = CastorToDict(study_name, client_id, client_secret, log_level, fields, cache_dir)
         self.output_db_file = output_db_file
         self.add_timestamp = add_timestamp        
         self.log_level = log_level
+        self.pipelined = pipelined
+        self.batch_size = batch_size
+        self.materialize = materialize
+        self.column_stats = column_stats
+        self.history = history
+        self.history_key_field = history_key_field
         logging.root.setLevel(self.log_level)
 
+    def execute_pipelined(self):
+        # Download, parse, type conversion and writing run as concurrent stages and rows
+        # are committed in batches, so the study is never held in memory as a whole. No
+        # JSON dump is written in this mode
+        client = self.castor2dict.create_client()
+        study_id = client.get_study_id(client.get_study(self.castor2dict.study_name))
+        plan = client.get_study_schema_plan(study_id).select(self.castor2dict.fields)
+        output_db_file = DictToSqlite3.get_output_db_file(self.output_db_file, self.add_timestamp)
+        pipeline = StudyDataPipeline(
+            client, study_id, plan, output_db_file, self.batch_size,
+            materialize=MaterializedViews.create(self.materialize), column_stats=self.column_stats)
+        pipeline.execute()
+        if self.history is not None:
+            DictToSqlite3.add_to_history(self.history, self.history_key_field, output_db_file)
+        return output_db_file
+
     def execute(self):
+        if self.pipelined:
+            return self.execute_pipelined()
         data = self.castor2dict.execute()
         with open(self.output_db_file + '.json', 'w') as f:
             json.dump(data, f)
-        dict2sqlite = DictToSqlite3(data, self.output_db_file, self.add_timestamp, self.log_level)
+        dict2sqlite = DictToSqlite3(
+            data, self.output_db_file, self.add_timestamp, self.log_level, plan=self.castor2dict.plan,
+            materialize=self.materialize, column_stats=self.column_stats,
+            history=self.history, history_key_field=self.history_key_field)
         return dict2sqlite.execute()
 
 
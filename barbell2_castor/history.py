@@ -0,0 +1,224 @@
+import os
+import re
+import json
+import zlib
+import hashlib
+import logging
+import sqlite3
+
+from datetime import datetime, date
+from barbell2_castor.schema import RECORD_ID_COLUMN
+
+
+logger = logging.getLogger(__name__)
+
+
+class ExportHistory:
+
+    # Stores a series of exports in a single SQLite file. The first export is the base
+    # snapshot, every later export only adds the records that were added, changed or
+    # removed since the previous one. Record contents are stored once per distinct
+    # content hash, so unchanged records cost no extra space
+
+    def __init__(self, history_file, key_field=None):
+        # key_field is the column that identifies a record across exports. It defaults
+        # to the record_id column of the export, or the row number for exports without one
+        self.history_file = history_file
+        self.db = sqlite3.connect(self.history_file)
+        self.create_tables()
+        self.key_field = self.get_key_field(key_field)
+
+    @staticmethod
+    def create(history, key_field=None):
+        if history is None or isinstance(history, ExportHistory):
+            return history
+        return ExportHistory(history, key_field)
+
+    def close(self):
+        if self.db:
+            self.db.close()
+            self.db = None
+
+    def create_tables(self):
+        cursor = self.db.cursor()
+        cursor.execute('CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value TEXT);')
+        cursor.execute(
+            'CREATE TABLE IF NOT EXISTS versions (version_id INTEGER PRIMARY KEY, exported_at TEXT, '
+            'label TEXT, columns TEXT);')
+        cursor.execute('CREATE TABLE IF NOT EXISTS contents (hash TEXT PRIMARY KEY, content BLOB);')
+        cursor.execute(
+            'CREATE TABLE IF NOT EXISTS changes (version_id INTEGER, record_key, hash TEXT, '
+            'PRIMARY KEY (record_key, version_id));')
+        cursor.execute('CREATE INDEX IF NOT EXISTS changes_version ON changes (version_id);')
+        self.db.commit()
+
+    def get_key_field(self, key_field):
+        cursor = self.db.cursor()
+        row = cursor.execute("SELECT value FROM meta WHERE name = 'key_field';").fetchone()
+        if row is not None:
+            if key_field is not None and key_field != row[0]:
+                raise RuntimeError(f'History {self.history_file} uses key field {row[0]}, not {key_field}')
+            return row[0]
+        if key_field is not None:
+            cursor.execute("INSERT INTO meta VALUES ('key_field', ?);", (key_field,))
+            self.db.commit()
+        return key_field
+
+    @staticmethod
+    def to_timestamp(value):
+        # Timestamps are stored and compared as 'YYYY-MM-DD HH:MM:SS' text in local time.
+        # A date means the end of that day
+        if isinstance(value, str):
+            if len(value) == 10:
+                value = date.fromisoformat(value)
+            else:
+                value = datetime.fromisoformat(value)
+        if isinstance(value, datetime):
+            if value.tzinfo is not None:
+                value = value.astimezone().replace(tzinfo=None)
+            return value.strftime('%Y-%m-%d %H:%M:%S')
+        return value.isoformat() + ' 23:59:59'
+
+    @staticmethod
+    def get_exported_at(db_file):
+        # Uses the timestamp that DictToSqlite3(add_timestamp=True) adds to the file name
+        match = re.search(r'-(\d{14})\.[^.]*$', db_file)
+        if match is not None:
+            return datetime.strptime(match.group(1), '%Y%m%d%H%M%S')
+        return datetime.fromtimestamp(os.path.getmtime(db_file))
+
+    @staticmethod
+    def compute_hash(content):
+        return hashlib.sha256(content).hexdigest()
+
+    def add_database(self, db_file, exported_at=None, label=None):
+        if exported_at is None:
+            exported_at = self.get_exported_at(db_file)
+        conn = sqlite3.connect(db_file)
+        try:
+            columns = [(row[1], row[2]) for row in conn.execute('PRAGMA table_info(data);')]
+            rows = conn.execute('SELECT * FROM data;')
+            return self.add_rows(columns, rows, exported_at, label or os.path.basename(db_file))
+        finally:
+            conn.close()
+
+    def add_rows(self, columns, rows, exported_at, label=None):
+        column_names = [column[0] for column in columns]
+        key_field = self.key_field
+        if key_field is None:
+            key_field = RECORD_ID_COLUMN if RECORD_ID_COLUMN in column_names else 'id'
+        key_index = column_names.index(key_field)
+        previous = self.get_record_hashes(self.get_latest_version_id())
+        cursor = self.db.cursor()
+        cursor.execute(
+            'INSERT INTO versions (exported_at, label, columns) VALUES (?, ?, ?);',
+            (self.to_timestamp(exported_at), label, json.dumps(columns)))
+        version_id = cursor.lastrowid
+        record_keys = set()
+        nr_changes = 0
+        for row in rows:
+            record_key = row[key_index]
+            record_keys.add(record_key)
+            record = dict(zip(column_names, row))
+            if key_field != 'id':
+                # Row numbers shift when records are added or removed
+                record.pop('id', None)
+            content = json.dumps(record, sort_keys=True, default=str).encode('utf-8')
+            content_hash = self.compute_hash(content)
+            if previous.get(record_key) == content_hash:
+                continue
+            cursor.execute('INSERT OR IGNORE INTO contents VALUES (?, ?);', (content_hash, zlib.compress(content)))
+            cursor.execute('INSERT INTO changes VALUES (?, ?, ?);', (version_id, record_key, content_hash))
+            nr_changes += 1
+        for record_key in previous.keys():
+            if record_key not in record_keys:
+                cursor.execute('INSERT INTO changes VALUES (?, ?, NULL);', (version_id, record_key))
+                nr_changes += 1
+        self.db.commit()
+        logger.info(f'added version {version_id} with {nr_changes} changed records')
+        return version_id
+
+    def get_versions(self):
+        return self.db.execute('SELECT version_id, exported_at, label FROM versions ORDER BY version_id;').fetchall()
+
+    def get_latest_version_id(self):
+        return self.db.execute('SELECT MAX(version_id) FROM versions;').fetchone()[0]
+
+    def get_version_id(self, as_of):
+        # Latest version exported on or before as_of (datetime, date or string)
+        row = self.db.execute(
+            'SELECT MAX(version_id) FROM versions WHERE exported_at <= ?;', (self.to_timestamp(as_of),)).fetchone()
+        if row[0] is None:
+            raise RuntimeError(f'No export in {self.history_file} on or before {as_of}')
+        return row[0]
+
+    def get_record_hashes(self, version_id):
+        # Content hash of each record as it was in the given version
+        if version_id is None:
+            return {}
+        rows = self.db.execute(
+            'SELECT c.record_key, c.hash FROM changes c WHERE c.version_id = ('
+            'SELECT MAX(version_id) FROM changes WHERE record_key = c.record_key AND version_id <= ?) '
+            'AND c.hash IS NOT NULL ORDER BY c.record_key;', (version_id,))
+        record_hashes = {}
+        for record_key, content_hash in rows:
+            record_hashes[record_key] = content_hash
+        return record_hashes
+
+    def get_record(self, content_hash):
+        row = self.db.execute('SELECT content FROM contents WHERE hash = ?;', (content_hash,)).fetchone()
+        return json.loads(zlib.decompress(row[0]).decode('utf-8'))
+
+    def diff(self, version_a, version_b):
+        # Only records touched by the versions between a and b need to be compared
+        version_a, version_b = min(version_a, version_b), max(version_a, version_b)
+        rows = self.db.execute(
+            'SELECT DISTINCT record_key FROM changes WHERE version_id > ? AND version_id <= ?;', (version_a, version_b))
+        record_keys = [row[0] for row in rows]
+        diff = {'added': [], 'removed': [], 'changed': []}
+        for record_key in record_keys:
+            hash_a = self.get_record_hash(record_key, version_a)
+            hash_b = self.get_record_hash(record_key, version_b)
+            if hash_a == hash_b:
+                continue
+            if hash_a is None:
+                diff['added'].append(record_key)
+            elif hash_b is None:
+                diff['removed'].append(record_key)
+            else:
+                diff['changed'].append(record_key)
+        return diff
+
+    def get_record_hash(self, record_key, version_id):
+        row = self.db.execute(
+            'SELECT hash FROM changes WHERE record_key = ? AND version_id <= ? ORDER BY version_id DESC LIMIT 1;',
+            (record_key, version_id)).fetchone()
+        if row is None:
+            return None
+        return row[0]
+
+    def restore(self, conn, as_of=None, version_id=None):
+        # Reconstructs the data table of a version (by default the latest export on or
+        # before as_of) in the given database connection
+        if version_id is None:
+            version_id = self.get_latest_version_id() if as_of is None else self.get_version_id(as_of)
+        columns = json.loads(self.db.execute('SELECT columns FROM versions WHERE version_id = ?;', (version_id,)).fetchone()[0])
+        column_names = [column[0] for column in columns]
+        cursor = conn.cursor()
+        cursor.execute('DROP TABLE IF EXISTS data;')
+        column_defs = []
+        for column_name, column_type in columns:
+            if column_name == 'id' and column_type == 'INTEGER':
+                column_defs.append('id INTEGER PRIMARY KEY')
+            else:
+                column_defs.append(f'{column_name} {column_type}')
+        cursor.execute(f'CREATE TABLE data ({", ".join(column_defs)});')
+        placeholders = ', '.join(['?'] * len(column_names))
+        rows = []
+        for content_hash in self.get_record_hashes(version_id).values():
+            record = self.get_record(content_hash)
+            rows.append([record.get(column_name) for column_name in column_names])
+        cursor.executemany(f'INSERT INTO data ({", ".join(column_names)}) VALUES ({placeholders});', rows)
+        conn.commit()
+        logger.info(f'restored version {version_id} with {len(rows)} records')
+        return version_id
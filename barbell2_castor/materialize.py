@@ -0,0 +1,240 @@
+import re
+import json
+import logging
+import sqlite3
+
+
+logger = logging.getLogger(__name__)
+
+
+# String literals and quoted identifiers, whose whitespace is significant
+QUOTED = r"'(?:[^']|'')*'" + r'|"(?:[^"]|"")*"'
+AGGREGATE_QUERY = re.compile(
+    r'^select (?P<columns>.+?) from data(?: where (?P<where>.+?))?(?: group by (?P<group_by>.+))?$',
+    re.IGNORECASE | re.DOTALL)
+COLUMN = re.compile(r'^(?P<expression>.+?)(?: as (?P<alias>\S+))?$', re.IGNORECASE | re.DOTALL)
+
+
+def tokenize_query(query):
+    # Splits a query (without its trailing semicolon) on whitespace outside quotes and
+    # returns each token with its offset in the query
+    tokens = []
+    for match in re.finditer(r'(?:' + QUOTED + r"|[^\s'\"])+", query):
+        tokens.append((match.group(0), match.start()))
+    return tokens
+
+
+def strip_query(query):
+    return query.rstrip().rstrip(';').rstrip()
+
+
+def normalize_query(query):
+    # Collapses whitespace outside quotes. Only used to match queries, whitespace in
+    # string literals is kept as is
+    return ' '.join(token for token, _ in tokenize_query(strip_query(query)))
+
+
+def split_columns(text):
+    # Splits a column or GROUP BY list on the commas outside parentheses
+    items = []
+    depth = 0
+    start = 0
+    for i in range(len(text)):
+        if text[i] == '(':
+            depth += 1
+        elif text[i] == ')':
+            depth -= 1
+        elif text[i] == ',' and depth == 0:
+            items.append(text[start:i].strip())
+            start = i + 1
+    items.append(text[start:].strip())
+    return items
+
+
+def parse_aggregate_query(query):
+    # Splits a normalized SELECT ... FROM data [WHERE ...] [GROUP BY ...] query into its
+    # columns (expression, output name), WHERE clause and GROUP BY expressions. Quoted text
+    # is masked while parsing, so keywords and commas inside it are ignored
+    quoted = []
+    def mask(match):
+        quoted.append(match.group(0))
+        return f'\x00{len(quoted) - 1}\x00'
+    def unmask(text):
+        if text is None:
+            return None
+        return re.sub(r'\x00(\d+)\x00', lambda match: quoted[int(match.group(1))], text)
+    match = AGGREGATE_QUERY.match(re.sub(QUOTED, mask, query))
+    if match is None:
+        return None
+    columns = []
+    for column in split_columns(match.group('columns')):
+        column_match = COLUMN.match(column)
+        expression = unmask(column_match.group('expression'))
+        name = unmask(column_match.group('alias')) or expression
+        if re.sub(r'\s', '', expression).upper() == 'COUNT(*)':
+            expression = 'COUNT(*)'
+        columns.append((expression, name))
+    group_by = []
+    if match.group('group_by') is not None:
+        group_by = [unmask(expression) for expression in split_columns(match.group('group_by'))]
+    return {'columns': columns, 'where': unmask(match.group('where')), 'group_by': group_by}
+
+
+def quote_identifier(name):
+    if re.match(r'^[A-Za-z_][A-Za-z0-9_$]*$', name) or name.startswith('"'):
+        return name
+    return '"' + name.replace('"', '""') + '"'
+
+
+class MaterializedViews:
+
+    # Config file layout (JSON):
+    #
+    # {
+    #     "cohorts": {
+    #         "resected": "dpca_resectie = 1"
+    #     },
+    #     "aggregates": {
+    #         "resected_per_month": {
+    #             "cohort": "resected",
+    #             "group_by": {"month": "strftime('%Y-%m', dpca_datok)"}
+    #         }
+    #     }
+    # }
+    #
+    # Each cohort becomes a table cohort_<name> with the rows of data matching its WHERE
+    # clause, each aggregate a table agg_<name> with a count per group. Definitions are
+    # stored in the materialized_views table so that CastorQueryRunner can answer
+    # matching queries from them
+
+    def __init__(self, config):
+        self.cohorts = config.get('cohorts', {})
+        self.aggregates = config.get('aggregates', {})
+
+    @classmethod
+    def from_file(cls, config_file):
+        with open(config_file, 'r') as f:
+            return cls(json.load(f))
+
+    @staticmethod
+    def create(config):
+        if config is None or isinstance(config, MaterializedViews):
+            return config
+        if isinstance(config, dict):
+            return MaterializedViews(config)
+        return MaterializedViews.from_file(config)
+
+    @staticmethod
+    def get_cohort_sql(where):
+        return f'SELECT * FROM data WHERE {where}'
+
+    def get_aggregate_sql(self, aggregate):
+        group_by = aggregate.get('group_by', {})
+        columns = ''
+        for alias, expression in group_by.items():
+            columns += f'{expression} AS {alias}, '
+        sql = f'SELECT {columns}COUNT(*) AS count FROM data'
+        where = aggregate.get('where')
+        if 'cohort' in aggregate.keys():
+            where = self.cohorts[aggregate['cohort']]
+        if where is not None:
+            sql += f' WHERE {where}'
+        if len(group_by) > 0:
+            sql += ' GROUP BY ' + ', '.join(group_by.values())
+        return sql
+
+    @staticmethod
+    def invalidate(conn):
+        # Drops previously materialized tables, which are stale once data is rewritten
+        cursor = conn.cursor()
+        try:
+            table_names = cursor.execute('SELECT table_name FROM materialized_views;').fetchall()
+        except sqlite3.Error:
+            table_names = []
+        for table_name in table_names:
+            cursor.execute(f'DROP TABLE IF EXISTS {table_name[0]};')
+        cursor.execute('DROP TABLE IF EXISTS materialized_views;')
+
+    def execute(self, conn):
+        self.invalidate(conn)
+        cursor = conn.cursor()
+        cursor.execute('CREATE TABLE materialized_views (name TEXT PRIMARY KEY, kind TEXT, table_name TEXT, definition TEXT);')
+        for name, where in self.cohorts.items():
+            table_name = f'cohort_{name}'
+            logger.info(f'materializing cohort {name}...')
+            cursor.execute(f'DROP TABLE IF EXISTS {table_name};')
+            cursor.execute(f'CREATE TABLE {table_name} AS {self.get_cohort_sql(where)};')
+            cursor.execute(f'CREATE UNIQUE INDEX {table_name}_id ON {table_name} (id);')
+            cursor.execute('INSERT INTO materialized_views VALUES (?, ?, ?, ?);', (name, 'cohort', table_name, where))
+        for name, aggregate in self.aggregates.items():
+            table_name = f'agg_{name}'
+            logger.info(f'materializing aggregate {name}...')
+            sql = self.get_aggregate_sql(aggregate)
+            cursor.execute(f'DROP TABLE IF EXISTS {table_name};')
+            cursor.execute(f'CREATE TABLE {table_name} AS {sql};')
+            group_by = list(aggregate.get('group_by', {}).keys())
+            if len(group_by) > 0:
+                cursor.execute(f'CREATE INDEX {table_name}_groups ON {table_name} ({", ".join(group_by)});')
+            cursor.execute('INSERT INTO materialized_views VALUES (?, ?, ?, ?);', (name, 'aggregate', table_name, sql))
+        conn.commit()
+
+
+class MaterializedViewRewriter:
+
+    # Cohorts match any query that ends in the cohort's FROM data WHERE clause, whatever
+    # columns it selects. Aggregates match queries with the same WHERE clause and GROUP
+    # BY expressions that select only group expressions and COUNT(*), with or without
+    # aliases, e.g. SELECT a, COUNT(*) FROM data GROUP BY a. Queries are compared with
+    # whitespace outside quotes collapsed
+
+    def __init__(self, conn):
+        self.cohorts = []
+        self.aggregates = []
+        if conn is None:
+            return
+        try:
+            rows = conn.cursor().execute('SELECT kind, table_name, definition FROM materialized_views;').fetchall()
+        except sqlite3.Error:
+            rows = []
+        for kind, table_name, definition in rows:
+            if kind == 'cohort':
+                self.cohorts.append(([token for token, _ in tokenize_query(strip_query(definition))], table_name))
+            else:
+                self.aggregates.append((parse_aggregate_query(normalize_query(definition)), table_name))
+
+    def rewrite(self, query):
+        rewritten = self.rewrite_aggregate(normalize_query(query))
+        if rewritten is not None:
+            return rewritten
+        # Cohort queries keep their original column list, cut from the query itself
+        body = strip_query(query)
+        tokens = tokenize_query(body)
+        for where, table_name in self.cohorts:
+            n = len(where) + 3
+            if len(tokens) <= n:
+                continue
+            keywords = [token.lower() for token, _ in tokens[-n:-n + 3]]
+            if keywords == ['from', 'data', 'where'] and [token for token, _ in tokens[-n + 3:]] == where:
+                return body[:tokens[-n][1]].rstrip() + f' FROM {table_name};'
+        return query
+
+    def rewrite_aggregate(self, normalized):
+        query = parse_aggregate_query(normalized)
+        if query is None:
+            return None
+        for aggregate, table_name in self.aggregates:
+            if query['where'] != aggregate['where'] or query['group_by'] != aggregate['group_by']:
+                continue
+            table_columns = dict(aggregate['columns'])
+            columns = []
+            for expression, name in query['columns']:
+                if expression not in table_columns.keys():
+                    break
+                name = quote_identifier(name)
+                if name == table_columns[expression]:
+                    columns.append(name)
+                else:
+                    columns.append(f'{table_columns[expression]} AS {name}')
+            else:
+                return f'SELECT {", ".join(columns)} FROM {table_name};'
+        return None
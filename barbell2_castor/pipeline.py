@@ -0,0 +1,189 @@
+import os
+import queue
+import logging
+import sqlite3
+import threading
+
+from barbell2_castor.schema import RECORD_ID_COLUMN
+from barbell2_castor.stats import ColumnStatistics
+
+
+logger = logging.getLogger(__name__)
+
+
+class StudyDataPipeline:
+
+    # Marks the end of the items in a queue
+    DONE = object()
+
+    def __init__(self, client, study_id, plan, output_db_file, batch_size=500, queue_size=16, materialize=None, column_stats=True):
+        self.client = client
+        self.study_id = study_id
+        self.plan = plan.with_record_id()
+        self.output_db_file = output_db_file
+        self.batch_size = batch_size
+        self.queue_size = queue_size
+        self.materialized_views = materialize
+        self.stats = None
+        if column_stats:
+            self.stats = ColumnStatistics(self.plan)
+        self.field_ids = list(self.plan.get_field_ids().keys())
+        self.abort = threading.Event()
+        self.errors = []
+        self.nr_records = 0
+
+    def put(self, q, item):
+        # Blocks while the queue is full unless another stage has failed
+        while not self.abort.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def get(self, q):
+        while not self.abort.is_set():
+            try:
+                return q.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        return self.DONE
+
+    def run_stage(self, stage, *args):
+        try:
+            stage(*args)
+        except Exception as e:
+            logger.error(f'{stage.__name__}() failed: {e}')
+            self.errors.append(e)
+            self.abort.set()
+
+    def download(self, lines_queue):
+        chunk = []
+        for line in self.client.iter_study_data_lines(self.study_id):
+            chunk.append(line)
+            if len(chunk) == self.batch_size:
+                if not self.put(lines_queue, chunk):
+                    return
+                chunk = []
+        if len(chunk) > 0:
+            self.put(lines_queue, chunk)
+        self.put(lines_queue, self.DONE)
+
+    def parse(self, lines_queue, records_queue):
+        # Lines of the data export are grouped per record, starting with a line that has
+        # an empty form type, so a record is complete as soon as the next one starts. An
+        # export that is not grouped this way cannot be streamed and raises an error, so
+        # the result never silently differs from get_study_data(). Only the IDs of
+        # completed records are kept to detect this
+        field_ids = set(self.field_ids)
+        record_id = None
+        record = None
+        completed = set()
+        while True:
+            chunk = self.get(lines_queue)
+            if chunk is self.DONE:
+                break
+            for line in chunk:
+                items = line.split(';')
+                if len(items) != 9:
+                    continue
+                if items[2] == '':
+                    if items[1] in completed or items[1] == record_id:
+                        raise RuntimeError(f'Record {items[1]} appears more than once in export/data')
+                    if record is not None:
+                        if not self.put(records_queue, record):
+                            return
+                        completed.add(record_id)
+                    record_id = items[1]
+                    record = {RECORD_ID_COLUMN: record_id}
+                elif items[2] == 'Study' and items[5] in field_ids:
+                    if items[1] != record_id:
+                        raise RuntimeError(f'Value of record {items[1]} outside its record group in export/data')
+                    record[items[5]] = items[6]
+        if record is not None:
+            self.put(records_queue, record)
+        self.put(records_queue, self.DONE)
+
+    def convert(self, records_queue, rows_queue):
+        batch = []
+        while True:
+            record = self.get(records_queue)
+            if record is self.DONE:
+                break
+            values = []
+            for field_id in self.field_ids:
+                values.append(record.get(field_id, ''))
+            row = self.plan.convert_row(values)
+            if self.stats is not None:
+                self.stats.update(row)
+            batch.append(row)
+            if len(batch) == self.batch_size:
+                if not self.put(rows_queue, batch):
+                    return
+                batch = []
+        if len(batch) > 0:
+            self.put(rows_queue, batch)
+        self.put(rows_queue, self.DONE)
+
+    def write(self, rows_queue):
+        # Everything is written to a temporary file next to the output file, which only
+        # replaces it once all batches, the statistics and the materialized views are
+        # written, so a failed export leaves the previous one intact
+        tmp_file = self.output_db_file + '.tmp'
+        stats_file = self.output_db_file + '.stats.json'
+        if os.path.isfile(tmp_file):
+            os.remove(tmp_file)
+        completed = False
+        conn = sqlite3.connect(tmp_file)
+        try:
+            cursor = conn.cursor()
+            cursor.execute(self.plan.create_table_sql)
+            while True:
+                batch = self.get(rows_queue)
+                if batch is self.DONE:
+                    break
+                cursor.executemany(self.plan.insert_sql, batch)
+                self.nr_records += len(batch)
+                logger.info(f'nr. records written: {self.nr_records}')
+            if self.abort.is_set():
+                return
+            if self.stats is not None:
+                self.stats.write(conn)
+            if self.materialized_views is not None:
+                self.materialized_views.execute(conn)
+            conn.commit()
+            if self.stats is not None:
+                self.stats.save(stats_file + '.tmp')
+            completed = True
+        finally:
+            conn.close()
+            if not completed:
+                for file_path in [tmp_file, stats_file + '.tmp']:
+                    if os.path.isfile(file_path):
+                        os.remove(file_path)
+        os.replace(tmp_file, self.output_db_file)
+        if self.stats is not None:
+            os.replace(stats_file + '.tmp', stats_file)
+        elif os.path.isfile(stats_file):
+            # Statistics of an earlier export no longer describe the data
+            os.remove(stats_file)
+
+    def execute(self):
+        lines_queue = queue.Queue(maxsize=self.queue_size)
+        records_queue = queue.Queue(maxsize=self.queue_size * self.batch_size)
+        rows_queue = queue.Queue(maxsize=self.queue_size)
+        threads = [
+            threading.Thread(target=self.run_stage, args=(self.download, lines_queue), daemon=True),
+            threading.Thread(target=self.run_stage, args=(self.parse, lines_queue, records_queue), daemon=True),
+            threading.Thread(target=self.run_stage, args=(self.convert, records_queue, rows_queue), daemon=True),
+        ]
+        for thread in threads:
+            thread.start()
+        self.run_stage(self.write, rows_queue)
+        for thread in threads:
+            thread.join()
+        if len(self.errors) > 0:
+            raise self.errors[0]
+        logger.info(f'nr. records: {self.nr_records}')
+        return self.output_db_file
@@ -2,6 +2,11 @@ import logging
 import sqlite3
 import pandas as pd
 
+from barbell2_castor.history import ExportHistory
+from barbell2_castor.materialize import MaterializedViews, MaterializedViewRewriter
+from barbell2_castor.shared import SharedStudyDataset
+from barbell2_castor.stats import load_column_stats
+
 # Recompiled version of sqlite3 with larger nr. of supported columns
 # from pysqlite3 import dbapi2 as sqlite3
 
@@ -12,12 +17,23 @@ logger = logging.getLogger(__name__)
 
 class CastorPandasQueryRunner:
 
-    def __init__(self, csv_file, sep=';', decimal='.'):
+    def __init__(self, csv_file=None, sep=';', decimal='.', df=None):
         self.csv_file = csv_file
-        self.df = pd.read_csv(csv_file, sep=sep, decimal=decimal, dtype=str)
-        self.df = self.convert_to_date_objects(self.df)
+        if df is None:
+            df = pd.read_csv(csv_file, sep=sep, decimal=decimal, dtype=str)
+            df = self.convert_to_date_objects(df)
+        self.df = df
         self.output = None
 
+    @classmethod
+    def from_shared(cls, path):
+        # Attaches to a dataset published by another process (see SharedStudyDataset)
+        # instead of loading and typing the CSV file again
+        return cls(df=SharedStudyDataset.attach(path))
+
+    def publish(self, path):
+        return SharedStudyDataset.publish(self.df, path)
+
     @staticmethod
     def convert_to_date_objects(df):
         for column in df.columns:
@@ -35,9 +51,29 @@ class CastorPandasQueryRunner:
 
 class CastorQueryRunner:
 
-    def __init__(self, db_file):
+    def __init__(self, db_file, use_materialized=True):
         self.db = self.load_db(db_file)
         self.output = None
+        self.use_materialized = use_materialized
+        self.rewriter = MaterializedViewRewriter(self.db)
+
+    @classmethod
+    def from_history(cls, history, as_of=None):
+        # Queries the study as it was in the latest export on or before as_of, rebuilt
+        # in memory from an ExportHistory
+        runner = cls(':memory:')
+        export_history = ExportHistory.create(history)
+        try:
+            export_history.restore(runner.db, as_of)
+        finally:
+            if export_history is not history:
+                export_history.close()
+        return runner
+
+    def materialize(self, config):
+        # Materializes cohorts and aggregates in an existing database (see MaterializedViews)
+        MaterializedViews.create(config).execute(self.db)
+        self.rewriter = MaterializedViewRewriter(self.db)
 
     def __del__(self):
         if self.db:
@@ -52,6 +88,10 @@ class CastorQueryRunner:
             logger.error(e)
         return None
 
+    def get_column_stats(self):
+        # Statistics per column computed at export time (see ColumnStatistics)
+        return load_column_stats(self.db)
+
     @staticmethod
     def get_column_names(data):
         column_names = []
@@ -59,11 +99,18 @@ class CastorQueryRunner:
             column_names.append(column[0])
         return column_names
     
+    def publish(self, path, query='SELECT * FROM data;'):
+        # Publishes the query output for worker processes, which attach to it with
+        # CastorPandasQueryRunner.from_shared(path)
+        return SharedStudyDataset.publish(self.execute(query), path)
+
     def to_csv(self, output_file):
         self.output.to_csv(output_file, sep=';', index=False)
 
     def execute(self, query):
         self.output = None
+        if self.use_materialized:
+            query = self.rewriter.rewrite(query)
         cursor = self.db.cursor()
         data = cursor.execute(query)
         df_data = []
@@ -0,0 +1,353 @@
+import os
+import json
+import hashlib
+import logging
+
+from datetime import datetime
+from barbell2_castor.selection import FieldSelection
+
+
+logger = logging.getLogger(__name__)
+
+
+CASTOR_TO_SQL_TYPES = {
+    'string': 'TEXT',
+    'textarea': 'TEXT',
+    'radio': 'TINYINT',
+    'dropdown': 'TINYINT',
+    'numeric': 'FLOAT',
+    'date': 'DATE',
+    'year': 'TINYINT',
+}
+FIELD_TYPES_TO_SKIP = ['calculation', 'remark']
+
+# Column holding the Castor record (participant) ID of each row
+RECORD_ID_COLUMN = 'record_id'
+RECORD_ID_FIELD = {
+    'field_id': RECORD_ID_COLUMN,
+    'field_name': RECORD_ID_COLUMN,
+    'field_type': 'string',
+    'option_group': '',
+    'form_name': None,
+    'phase_name': None,
+}
+OPTION_FIELD_TYPES = ['radio', 'dropdown']
+
+
+def check_field_name(field_name):
+    # Every export adds the record_id column, so a study variable cannot use its name
+    if field_name == RECORD_ID_COLUMN:
+        raise RuntimeError(f'Variable name {RECORD_ID_COLUMN} is reserved for the Castor record ID, please rename the variable')
+
+
+def convert_field_value(field_type, value, empty=None):
+    if value is None or value == '':
+        return empty
+    try:
+        if field_type == 'radio' or field_type == 'dropdown' or field_type == 'year':
+            return int(float(value))
+        if field_type == 'numeric':
+            return float(value)
+        if field_type == 'date':
+            return datetime.strptime(value, '%d-%m-%Y').date()
+    except ValueError:
+        logger.warning(f'ValueError ({field_type}): value={value}')
+    return str(value)
+
+
+class StudySchemaPlan:
+
+    # Plans built from the structure and option group exports are cached on disk, in
+    # default_cache_dir unless another cache_dir is given, or not at all with
+    # cache_dir=False. Only the max_cached_plans most recently used plans are kept. Other
+    # backends (Excel, dicts) reuse a cached plan when given the plan or its key
+
+    # Bump when the layout of the plan changes so that cached plans are rebuilt
+    version = 1
+    default_cache_dir = os.path.join(os.path.expanduser('~'), '.barbell2_castor', 'schema')
+    max_cached_plans = 32
+
+    def __init__(self, key, fields, option_groups):
+        # Each field is a dict with field_id, field_name, field_type, option_group,
+        # form_name and phase_name. Option groups map option value to option name
+        self.key = key
+        self.fields = fields
+        self.option_groups = option_groups
+        self.field_names = [field['field_name'] for field in self.fields]
+        self.field_types = {}
+        self.field_options = {}
+        for field in self.fields:
+            self.field_types[field['field_name']] = field['field_type']
+            self.field_options[field['field_name']] = self.option_groups.get(field['option_group'])
+        self.create_table_sql = self.compile_create_table_sql()
+        self.insert_sql = self.compile_insert_sql()
+        self.expanded_columns = self.compile_expanded_columns()
+
+    @staticmethod
+    def create(plan, cache_dir=None):
+        if plan is None or isinstance(plan, StudySchemaPlan):
+            return plan
+        cached_plan = StudySchemaPlan.load(plan, cache_dir)
+        if cached_plan is None:
+            raise RuntimeError(f'No cached schema plan {plan}')
+        return cached_plan
+
+    @staticmethod
+    def get_cache_dir(cache_dir=None):
+        if cache_dir is None:
+            return StudySchemaPlan.default_cache_dir
+        return cache_dir
+
+    @staticmethod
+    def get_cache_file(key, cache_dir=None):
+        return os.path.join(StudySchemaPlan.get_cache_dir(cache_dir), f'{key}.json')
+
+    @staticmethod
+    def compute_key(text):
+        h = hashlib.sha256()
+        h.update(f'v{StudySchemaPlan.version}\n'.encode('utf-8'))
+        h.update(text.encode('utf-8'))
+        return h.hexdigest()
+
+    @classmethod
+    def from_exports(cls, structure_text, optiongroups_text, cache_dir=None):
+        # Options can be added to an existing option group without changing the study
+        # structure, so the key covers both exports
+        key = cls.compute_key(structure_text + '\n' + optiongroups_text)
+        if cache_dir is not False:
+            plan = cls.load(key, cache_dir)
+            if plan is not None:
+                logger.info(f'using cached schema plan {key}')
+                return plan
+        logger.info(f'building schema plan {key}...')
+        fields = []
+        for line in structure_text.split('\n')[1:]:
+            items = line.split(';')
+            if len(items) == 16:
+                field_type = items[11]
+                if field_type not in FIELD_TYPES_TO_SKIP:
+                    fields.append({
+                        'field_id': items[8],
+                        'field_name': items[9],
+                        'field_type': field_type,
+                        'option_group': items[15],
+                        'form_name': items[6],
+                        'phase_name': items[3],
+                    })
+        option_groups = {}
+        for line in optiongroups_text.split('\n')[1:]:
+            items = line.split(';')
+            if len(items) == 6:
+                option_group_id = items[1]
+                if option_group_id not in option_groups.keys():
+                    option_groups[option_group_id] = {}
+                option_groups[option_group_id][items[5]] = items[4]  # value, name
+        plan = cls(key, fields, option_groups)
+        if cache_dir is not False:
+            plan.save(cache_dir)
+        return plan
+
+    @classmethod
+    def from_data(cls, data):
+        # Plans for dicts that did not come from the structure export (e.g. Excel) use
+        # the field names, types and options in the dict as their key
+        fields = []
+        option_groups = {}
+        for field_name in data.keys():
+            field_options = data[field_name].get('field_options')
+            option_group = ''
+            if field_options is not None:
+                option_group = field_name
+                option_groups[option_group] = field_options
+            fields.append({
+                'field_id': field_name,
+                'field_name': field_name,
+                'field_type': data[field_name]['field_type'],
+                'option_group': option_group,
+                'form_name': data[field_name].get('form_name'),
+                'phase_name': data[field_name].get('phase_name'),
+            })
+        key = cls.compute_key(json.dumps([fields, option_groups]))
+        return cls(key, fields, option_groups)
+
+    @classmethod
+    def load(cls, key, cache_dir=None):
+        cache_file = cls.get_cache_file(key, cache_dir)
+        if not os.path.isfile(cache_file):
+            return None
+        try:
+            with open(cache_file, 'r') as f:
+                plan = json.load(f)
+            plan = cls(plan['key'], plan['fields'], plan['option_groups'])
+        except (ValueError, KeyError) as e:
+            logger.warning(f'ignoring corrupt schema plan {cache_file}: {e}')
+            return None
+        try:
+            # Marks the plan as recently used, see prune()
+            os.utime(cache_file)
+        except OSError:
+            pass
+        return plan
+
+    def save(self, cache_dir=None):
+        cache_file = self.get_cache_file(self.key, cache_dir)
+        try:
+            os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+            with open(cache_file + '.tmp', 'w') as f:
+                json.dump({'key': self.key, 'fields': self.fields, 'option_groups': self.option_groups}, f)
+            os.replace(cache_file + '.tmp', cache_file)
+            self.prune(cache_dir)
+        except OSError as e:
+            logger.warning(f'could not cache schema plan {cache_file}: {e}')
+        return cache_file
+
+    @classmethod
+    def prune(cls, cache_dir=None):
+        # Removes the least recently used plans beyond max_cached_plans
+        cache_dir = cls.get_cache_dir(cache_dir)
+        cache_files = []
+        for file_name in os.listdir(cache_dir):
+            if file_name.endswith('.json'):
+                cache_files.append(os.path.join(cache_dir, file_name))
+        cache_files.sort(key=os.path.getmtime, reverse=True)
+        for cache_file in cache_files[cls.max_cached_plans:]:
+            os.remove(cache_file)
+            logger.info(f'removed schema plan {cache_file}')
+
+    def select(self, fields):
+        selection = FieldSelection.create(fields)
+        if selection is None:
+            return self
+        selected = []
+        for field in self.fields:
+            if selection.matches(field['field_name'], field['form_name'], field['phase_name']):
+                selected.append(field)
+        selection.check_selected(selected)
+        if self.has_record_id() and selected[0] is not self.fields[0]:
+            selected.insert(0, self.fields[0])
+        option_groups = {}
+        for field in selected:
+            if field['option_group'] in self.option_groups.keys():
+                option_groups[field['option_group']] = self.option_groups[field['option_group']]
+        key = self.compute_key(self.key + json.dumps([field['field_id'] for field in selected]))
+        return StudySchemaPlan(key, selected, option_groups)
+
+    def has_record_id(self):
+        return len(self.fields) > 0 and self.fields[0]['field_id'] == RECORD_ID_COLUMN
+
+    def with_record_id(self):
+        # Plan with the record ID as its first column
+        if self.has_record_id():
+            return self
+        for field_name in self.field_names:
+            check_field_name(field_name)
+        key = self.compute_key(self.key + '\n' + RECORD_ID_COLUMN)
+        return StudySchemaPlan(key, [dict(RECORD_ID_FIELD)] + self.fields, self.option_groups)
+
+    def get_field_ids(self):
+        field_ids = {}
+        for field in self.fields:
+            field_ids[field['field_id']] = field['field_name']
+        return field_ids
+
+    def get_field_defs(self):
+        field_defs = {}
+        for field in self.fields:
+            field_defs[field['field_id']] = [field['field_name'], field['field_type'], field['option_group']]
+        return field_defs
+
+    def create_data(self):
+        data = {}
+        for field in self.fields:
+            field_name = field['field_name']
+            data[field_name] = {
+                'field_type': self.field_types[field_name],
+                'field_options': self.field_options[field_name],
+                'form_name': field['form_name'],
+                'phase_name': field['phase_name'],
+                'field_values': [],
+            }
+        return data
+
+    def get_data_field_ids(self):
+        # Field IDs to read from export/data, the record ID comes from the record lines
+        field_ids = self.get_field_ids()
+        field_ids.pop(RECORD_ID_COLUMN, None)
+        return field_ids
+
+    @staticmethod
+    def add_study_data_line(records, field_ids, line):
+        # Adds a line of export/data to the records dict, keeping only values of the
+        # given fields. Lets callers that stream the export build study data line by line
+        items = line.split(';')
+        if len(items) == 9:
+            record_id = items[1]
+            form_type = items[2]
+            if form_type == '':
+                records[record_id] = {}
+            elif form_type == 'Study':
+                field_id = items[5]
+                if field_id in field_ids:
+                    records[record_id][field_id] = items[6]
+
+    def build_study_data(self, lines):
+        # Builds the study data dict from the lines of export/data (without header). Lines
+        # can be any iterable, e.g. a streamed export
+        field_ids = self.get_data_field_ids()
+        records = {}
+        for line in lines:
+            self.add_study_data_line(records, field_ids, line)
+        return self.create_study_data(records)
+
+    def create_study_data(self, records):
+        # The first column holds the record ID of each row
+        logger.info('building study data...')
+        field_ids = self.get_data_field_ids()
+        data = self.with_record_id().create_data()
+        data[RECORD_ID_COLUMN]['field_values'] = list(records.keys())
+        for field_id, field_name in field_ids.items():
+            # Records without a value for this field get an empty string
+            field_values = data[field_name]['field_values']
+            for record_id in records.keys():
+                field_values.append(records[record_id].get(field_id, ''))
+        return data
+
+    def get_sql_type(self, field_name):
+        return CASTOR_TO_SQL_TYPES.get(self.field_types[field_name], 'TEXT')
+
+    def compile_create_table_sql(self):
+        sql = 'CREATE TABLE data (id INTEGER PRIMARY KEY, '
+        for field_name in self.field_names:
+            sql += '{} {}, '.format(field_name, self.get_sql_type(field_name))
+        sql = sql[:-2] + ');'
+        return sql
+
+    def compile_insert_sql(self):
+        columns = ', '.join(self.field_names)
+        placeholders = ', '.join(['?'] * len(self.field_names))
+        return f'INSERT INTO data ({columns}) VALUES ({placeholders});'
+
+    def compile_expanded_columns(self):
+        # Columns after one-hot encoding option fields as <field_name>$<option_value>
+        columns = []
+        for field_name in self.field_names:
+            field_options = self.field_options[field_name]
+            if self.field_types[field_name] in OPTION_FIELD_TYPES and field_options is not None:
+                for option_value in field_options.keys():
+                    columns.append((f'{field_name}${option_value}', field_name, option_value))
+            else:
+                columns.append((field_name, field_name, None))
+        return columns
+
+    def get_expanded_column_names(self):
+        return [column[0] for column in self.expanded_columns]
+
+    def convert(self, field_name, value, empty=None):
+        return convert_field_value(self.field_types[field_name], value, empty)
+
+    def convert_row(self, values, empty=''):
+        # Converts a list of raw values, ordered as field_names, to SQL values
+        row = []
+        for i in range(len(self.field_names)):
+            row.append(convert_field_value(self.field_types[self.field_names[i]], values[i], empty))
+        return row
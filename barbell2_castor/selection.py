@@ -0,0 +1,53 @@
+import fnmatch
+
+
+class FieldSelection:
+
+    def __init__(self, patterns):
+        # Patterns can be variable names, glob patterns (e.g. dpca_neo*) or the names
+        # of Castor forms or phases. A field is selected if any pattern matches
+        if isinstance(patterns, str):
+            patterns = [patterns]
+        self.patterns = list(patterns)
+
+    @staticmethod
+    def create(fields):
+        if fields is None or isinstance(fields, FieldSelection):
+            return fields
+        return FieldSelection(fields)
+
+    def matches(self, field_name, form_name=None, phase_name=None):
+        for name in [field_name, form_name, phase_name]:
+            if not isinstance(name, str) or name == '':
+                continue
+            for pattern in self.patterns:
+                if fnmatch.fnmatchcase(name, pattern):
+                    return True
+        return False
+
+    def check_selected(self, selected):
+        if len(selected) == 0:
+            raise RuntimeError(
+                f'Field selection {self.patterns} matches no fields (form and phase names can only be '
+                'matched for data that carries form_name/phase_name, e.g. from the Castor API or Excel export)')
+
+    def select(self, data, always=None):
+        # Fields listed in always (e.g. the record ID) are kept regardless of the patterns
+        if always is None:
+            always = []
+        selected = {}
+        for field_name in data.keys():
+            if self.matches(field_name, data[field_name].get('form_name'), data[field_name].get('phase_name')):
+                selected[field_name] = data[field_name]
+        self.check_selected(selected)
+        for field_name in reversed(always):
+            if field_name in data.keys() and field_name not in selected.keys():
+                selected = {field_name: data[field_name], **selected}
+        return selected
+
+
+def select_fields(data, fields, always=None):
+    selection = FieldSelection.create(fields)
+    if selection is None:
+        return data
+    return selection.select(data, always)
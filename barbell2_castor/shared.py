@@ -0,0 +1,143 @@
+import os
+import json
+import uuid
+import logging
+import numpy as np
+import pandas as pd
+
+
+logger = logging.getLogger(__name__)
+
+
+class SharedStudyDataset:
+
+    # Publishes a typed DataFrame as a single memory-mapped file (put it on /dev/shm to
+    # keep it in shared memory) plus a JSON manifest. Worker processes attach to it and
+    # get a DataFrame whose columns are read-only views on the mapped file, so the data
+    # is loaded and typed once and shared by all workers. Numeric, boolean and datetime
+    # columns are stored as is, all other columns as categorical codes. Each publish
+    # writes a new data file and then swaps the manifest, so workers that are attached
+    # to an earlier version keep a valid mapping
+
+    alignment = 64
+    attach_retries = 3
+
+    @staticmethod
+    def get_manifest_file(path):
+        return path + '.json'
+
+    @staticmethod
+    def get_data_file(path, manifest):
+        return os.path.join(os.path.dirname(path), manifest['data_file'])
+
+    @staticmethod
+    def get_codes_dtype(nr_categories):
+        # Same code width pandas uses, so Categorical.from_codes() does not copy
+        for dtype in [np.int8, np.int16, np.int32]:
+            if nr_categories < np.iinfo(dtype).max:
+                return np.dtype(dtype)
+        return np.dtype(np.int64)
+
+    @staticmethod
+    def coerce_column(column):
+        # Columns read from SQLite hold '' for missing numbers and columns read from CSV
+        # (dtype=str) hold numbers as strings. Such columns are stored as numbers, only
+        # text becomes categorical
+        if pd.api.types.is_object_dtype(column.dtype) or isinstance(column.dtype, pd.StringDtype):
+            values = column.astype(object)
+            values = values.where(values.notna() & (values != ''), np.nan)
+            try:
+                column = pd.to_numeric(values)
+            except (ValueError, TypeError):
+                return column
+        # Nullable extension types (boolean, Int64, Float64, ...) would be written as
+        # object arrays, so they are converted to numpy with NaN for missing values
+        if isinstance(column.dtype, pd.api.extensions.ExtensionDtype) and not isinstance(column.dtype, pd.CategoricalDtype) \
+                and (pd.api.types.is_bool_dtype(column.dtype) or pd.api.types.is_numeric_dtype(column.dtype)):
+            if column.isna().any():
+                return pd.Series(column.to_numpy(dtype=np.float64, na_value=np.nan), index=column.index, name=column.name)
+            return pd.Series(column.to_numpy(dtype=getattr(column.dtype, 'numpy_dtype', None)), index=column.index, name=column.name)
+        return column
+
+    @classmethod
+    def publish(cls, df, path):
+        columns = []
+        arrays = []
+        offset = 0
+        for column_name in df.columns:
+            column = cls.coerce_column(df[column_name])
+            kind = 'values'
+            categories = None
+            if pd.api.types.is_bool_dtype(column.dtype) or pd.api.types.is_numeric_dtype(column.dtype) \
+                    or pd.api.types.is_datetime64_dtype(column.dtype):
+                array = column.to_numpy()
+                if array.dtype == object:
+                    raise RuntimeError(f'Cannot publish column {column_name} of type {column.dtype}')
+            else:
+                # Values are converted to strings before the categories are built, so
+                # mixed values such as 1 and '1' end up in a single category
+                values = column.astype(object).where(column.notna(), None)
+                categorical = pd.Categorical(values.map(lambda value: None if value is None else str(value)))
+                categories = list(categorical.categories)
+                array = categorical.codes.astype(cls.get_codes_dtype(len(categories)))
+                kind = 'categorical'
+            offset = (offset + cls.alignment - 1) // cls.alignment * cls.alignment
+            columns.append({
+                'name': str(column_name),
+                'kind': kind,
+                'dtype': array.dtype.str,
+                'offset': offset,
+                'categories': categories,
+            })
+            arrays.append(array)
+            offset += array.nbytes
+        # Never write into a file that workers may have mapped (truncating it makes their
+        # reads fail with SIGBUS), always into a new one
+        data_file = f'{os.path.basename(path)}.{uuid.uuid4().hex}'
+        mm = np.memmap(os.path.join(os.path.dirname(path), data_file), dtype=np.uint8, mode='w+', shape=(max(offset, 1),))
+        for column, array in zip(columns, arrays):
+            mm[column['offset']:column['offset'] + array.nbytes] = np.frombuffer(np.ascontiguousarray(array).tobytes(), dtype=np.uint8)
+        mm.flush()
+        del mm
+        # The manifest is written last, so workers never attach to a half-written file
+        manifest_file = cls.get_manifest_file(path)
+        previous_data_file = None
+        if os.path.isfile(manifest_file):
+            with open(manifest_file, 'r') as f:
+                previous_data_file = cls.get_data_file(path, json.load(f))
+        with open(manifest_file + '.tmp', 'w') as f:
+            json.dump({'nr_rows': len(df), 'data_file': data_file, 'columns': columns}, f)
+        os.replace(manifest_file + '.tmp', manifest_file)
+        # Attached workers keep their mapping of the previous data file after it is
+        # removed, its space is freed once they detach
+        if previous_data_file is not None and os.path.isfile(previous_data_file):
+            os.remove(previous_data_file)
+        logger.info(f'published {len(df)} rows, {len(columns)} columns to {path}')
+        return path
+
+    @classmethod
+    def open_data_file(cls, path):
+        # The data file can be removed by a new publish between reading the manifest
+        # and mapping it, in that case the new manifest is read
+        for attempt in range(cls.attach_retries):
+            with open(cls.get_manifest_file(path), 'r') as f:
+                manifest = json.load(f)
+            try:
+                return manifest, np.memmap(cls.get_data_file(path, manifest), dtype=np.uint8, mode='r')
+            except FileNotFoundError:
+                if attempt == cls.attach_retries - 1:
+                    raise
+                logger.warning(f'data file of {path} was replaced, reading manifest again')
+
+    @classmethod
+    def attach(cls, path):
+        manifest, mm = cls.open_data_file(path)
+        nr_rows = manifest['nr_rows']
+        data = {}
+        for column in manifest['columns']:
+            array = np.frombuffer(mm, dtype=np.dtype(column['dtype']), count=nr_rows, offset=column['offset'])
+            if column['kind'] == 'categorical':
+                data[column['name']] = pd.Categorical.from_codes(array, categories=column['categories'], validate=False)
+            else:
+                data[column['name']] = array
+        return pd.DataFrame(data, copy=False)
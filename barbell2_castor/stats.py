@@ -0,0 +1,137 @@
+import os
+import json
+import logging
+import sqlite3
+
+from collections import Counter
+from datetime import date
+from barbell2_castor.schema import OPTION_FIELD_TYPES
+
+
+logger = logging.getLogger(__name__)
+
+
+class ColumnStatistics:
+
+    # Collects missingness, cardinality, min/max and option value counts for each
+    # column while rows are converted for insertion, so no extra pass over the data
+    # (or full-table queries afterwards) is needed
+
+    # Distinct values are tracked exactly up to this number per column, beyond that the
+    # cardinality is reported as at least max_distinct so memory stays bounded
+    max_distinct = 1000
+
+    def __init__(self, plan, max_distinct=None):
+        self.plan = plan
+        if max_distinct is not None:
+            self.max_distinct = max_distinct
+        self.nr_records = 0
+        self.nr_missing = [0] * len(self.plan.field_names)
+        self.distinct = [set() for _ in self.plan.field_names]
+        self.min_values = [None] * len(self.plan.field_names)
+        self.max_values = [None] * len(self.plan.field_names)
+        self.option_counts = {}
+        for i in range(len(self.plan.field_names)):
+            if self.plan.field_types[self.plan.field_names[i]] in OPTION_FIELD_TYPES:
+                self.option_counts[i] = Counter()
+
+    def update(self, row):
+        # Expects a converted row, ordered as the plan's field names
+        self.nr_records += 1
+        for i in range(len(row)):
+            value = row[i]
+            if value is None or value == '':
+                self.nr_missing[i] += 1
+                continue
+            if self.distinct[i] is not None:
+                self.distinct[i].add(value)
+                if len(self.distinct[i]) > self.max_distinct:
+                    self.distinct[i] = None
+            if i in self.option_counts.keys():
+                self.option_counts[i][value] += 1
+            if isinstance(value, (int, float, date)):
+                if self.min_values[i] is None or value < self.min_values[i]:
+                    self.min_values[i] = value
+                if self.max_values[i] is None or value > self.max_values[i]:
+                    self.max_values[i] = value
+
+    def track(self, rows):
+        for row in rows:
+            self.update(row)
+            yield row
+
+    @staticmethod
+    def to_json_value(value):
+        if isinstance(value, date):
+            return value.isoformat()
+        return value
+
+    def get_column_stats(self):
+        column_stats = []
+        for i in range(len(self.plan.field_names)):
+            field_name = self.plan.field_names[i]
+            option_counts = None
+            if i in self.option_counts.keys():
+                option_counts = {}
+                for value in sorted(self.option_counts[i].keys(), key=str):
+                    option_counts[str(value)] = self.option_counts[i][value]
+            column_stats.append({
+                'column_name': field_name,
+                'field_type': self.plan.field_types[field_name],
+                'nr_records': self.nr_records,
+                'nr_missing': self.nr_missing[i],
+                'cardinality': self.max_distinct if self.distinct[i] is None else len(self.distinct[i]),
+                'cardinality_exact': self.distinct[i] is not None,
+                'min_value': self.to_json_value(self.min_values[i]),
+                'max_value': self.to_json_value(self.max_values[i]),
+                'option_counts': option_counts,
+            })
+        return column_stats
+
+    @staticmethod
+    def invalidate(conn, stats_file):
+        # Removes statistics of an earlier export when none are computed for this one
+        conn.cursor().execute('DROP TABLE IF EXISTS column_stats;')
+        if os.path.isfile(stats_file):
+            os.remove(stats_file)
+
+    def write(self, conn):
+        cursor = conn.cursor()
+        cursor.execute('DROP TABLE IF EXISTS column_stats;')
+        cursor.execute(
+            'CREATE TABLE column_stats (column_name TEXT PRIMARY KEY, field_type TEXT, nr_records INTEGER, '
+            'nr_missing INTEGER, cardinality INTEGER, cardinality_exact INTEGER, min_value, max_value, '
+            'option_counts TEXT);')
+        rows = []
+        for stats in self.get_column_stats():
+            option_counts = None
+            if stats['option_counts'] is not None:
+                option_counts = json.dumps(stats['option_counts'])
+            rows.append((
+                stats['column_name'], stats['field_type'], stats['nr_records'], stats['nr_missing'],
+                stats['cardinality'], int(stats['cardinality_exact']), stats['min_value'], stats['max_value'],
+                option_counts))
+        cursor.executemany('INSERT INTO column_stats VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?);', rows)
+        conn.commit()
+
+    def save(self, stats_file):
+        with open(stats_file, 'w') as f:
+            json.dump(self.get_column_stats(), f, indent=4)
+        logger.info(f'column statistics saved to {stats_file}')
+        return stats_file
+
+
+def load_column_stats(db):
+    column_stats = {}
+    try:
+        rows = db.cursor().execute('SELECT * FROM column_stats;')
+        column_names = [column[0] for column in rows.description]
+        for row in rows:
+            stats = dict(zip(column_names, row))
+            stats['cardinality_exact'] = bool(stats['cardinality_exact'])
+            if stats['option_counts'] is not None:
+                stats['option_counts'] = json.loads(stats['option_counts'])
+            column_stats[stats['column_name']] = stats
+    except sqlite3.Error as e:
+        logger.error(e)
+    return column_stats
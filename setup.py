@@ -12,6 +12,10 @@ requirements = [
     'pandas',
 ]
 
+extra_requirements = {
+    'async': ['aiohttp'],
+}
+
 setup_requirements = []
 
 test_requirements = []
@@ -33,6 +37,7 @@ setup(
     ],
     description="Utilities for interfacing with Castor EDC",
     install_requires=requirements,
+    extras_require=extra_requirements,
     license="MIT license",
     include_package_data=True,
     keywords='barbell2_castor',
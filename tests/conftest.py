@@ -0,0 +1,113 @@
+import io
+import json
+import pytest
+import requests
+
+from barbell2_castor.api import CastorApiClient
+from barbell2_castor.schema import StudySchemaPlan
+
+
+FIELDS = [
+    {'field_id': 'F1', 'field_name': 'age', 'field_type': 'numeric', 'option_group': '', 'form_name': 'Demo', 'phase_name': 'Baseline'},
+    {'field_id': 'F2', 'field_name': 'sex', 'field_type': 'radio', 'option_group': 'OG1', 'form_name': 'Demo', 'phase_name': 'Baseline'},
+    {'field_id': 'F3', 'field_name': 'dat', 'field_type': 'date', 'option_group': '', 'form_name': 'Op', 'phase_name': 'Surgery'},
+    {'field_id': 'F4', 'field_name': 'remarks', 'field_type': 'string', 'option_group': '', 'form_name': 'Op', 'phase_name': 'Surgery'},
+]
+OPTION_GROUPS = {'OG1': {'1': 'Male', '2': 'Female'}}
+
+
+def create_lines(record_numbers, changed=None):
+    # Lines of export/data (without header) for records R<i>. The age of record <changed>
+    # differs from its default value
+    lines = []
+    for i in record_numbers:
+        lines.append(f'S;R{i};;;;;;;')
+        lines.append(f'S;R{i};Study;x;x;F1;{i + 100 if i == changed else i}.5;x;x')
+        if i % 2 == 0:
+            lines.append(f'S;R{i};Study;x;x;F2;{i % 4 // 2 + 1};x;x')
+        if i % 3 == 0:
+            lines.append(f'S;R{i};Study;x;x;F3;0{i % 9 + 1}-01-2020;x;x')
+        lines.append(f'S;R{i};Study;x;x;F4;remark {i};x;x')
+    return lines
+
+
+@pytest.fixture(autouse=True)
+def schema_cache_dir(tmp_path, monkeypatch):
+    # Keeps tests from writing schema plans to the home directory
+    cache_dir = str(tmp_path / 'schema')
+    monkeypatch.setattr(StudySchemaPlan, 'default_cache_dir', cache_dir)
+    return cache_dir
+
+
+def create_structure_export(fields):
+    lines = [';'.join(['column'] * 16)]
+    for field in fields:
+        items = [''] * 16
+        items[3] = field['phase_name']
+        items[6] = field['form_name']
+        items[8] = field['field_id']
+        items[9] = field['field_name']
+        items[11] = field['field_type']
+        items[15] = field['option_group']
+        lines.append(';'.join(items))
+    return '\n'.join(lines)
+
+
+def create_optiongroups_export(option_groups):
+    lines = [';'.join(['column'] * 6)]
+    for option_group_id, options in option_groups.items():
+        for option_value, option_name in options.items():
+            lines.append(f'x;{option_group_id};x;x;{option_name};{option_value}')
+    return '\n'.join(lines)
+
+
+def create_response(url, body, status_code=200):
+    # Real responses, so that text, json() and iter_lines() behave as they do for Castor
+    if not isinstance(body, str):
+        body = json.dumps(body)
+    response = requests.Response()
+    response.url = url
+    response.status_code = status_code
+    response.encoding = 'utf-8'
+    response.raw = io.BytesIO(body.encode('utf-8'))
+    return response
+
+
+class StubSession:
+
+    def __init__(self, client):
+        self.client = client
+        self.token = {'access_token': 'token'}
+
+    def get(self, url, stream=False):
+        self.client.requested.append(url)
+        if stream:
+            self.client.streamed.append(url)
+        route = self.client.routes.get(url[len(CastorApiClient.api_url):])
+        if route is None:
+            return create_response(url, {}, 404)
+        if isinstance(route, tuple):
+            return create_response(url, route[1], route[0])
+        return create_response(url, route)
+
+    def close(self):
+        pass
+
+
+class StubApiClient(CastorApiClient):
+
+    # Serves the responses in routes (path after /api -> body or (status, body))
+    # instead of calling Castor
+
+    def __init__(self, routes):
+        self.routes = {'/study': {'_embedded': {'study': [{'name': 'Test', 'study_id': 'S'}]}}}
+        self.routes.update(routes)
+        self.requested = []
+        self.streamed = []
+        super(StubApiClient, self).__init__('id', 'secret')
+
+    def create_session(self, client_id, client_secret):
+        return StubSession(self)
+
+    def create_worker_session(self):
+        return StubSession(self)
@@ -0,0 +1,55 @@
+import pytest
+import requests
+
+from tests.conftest import FIELDS, OPTION_GROUPS, StubApiClient, create_structure_export, create_optiongroups_export
+
+
+VALUES = {'R1': {'F1': '61.5', 'F2': '1'}, 'R2': {'F1': '70', 'F2': '2'}, 'R3': {'F1': '45.0'}}
+
+
+def create_routes():
+    data_lines = ['header']
+    for record_id, record_values in VALUES.items():
+        data_lines.append(f'S;{record_id};;;;;;;')
+        for field_id, field_value in record_values.items():
+            data_lines.append(f'S;{record_id};Study;x;x;{field_id};{field_value};x;x')
+    routes = {
+        '/study/S/export/structure': create_structure_export(FIELDS),
+        '/study/S/export/optiongroups': create_optiongroups_export(OPTION_GROUPS),
+        '/study/S/export/data': '\n'.join(data_lines),
+    }
+    for record_id, record_values in VALUES.items():
+        items = [{'field_id': field_id, 'field_value': field_value} for field_id, field_value in record_values.items()]
+        routes[f'/study/S/participant/{record_id}/data-points/study'] = {'_embedded': {'items': items}}
+    return routes
+
+
+@pytest.mark.parametrize('export_threshold, from_export', [(0, True), (10, False)])
+def test_get_field_values(export_threshold, from_export):
+    client = StubApiClient(create_routes())
+    df = client.get_field_values('S', ['R3', 'R1', 'R2'], ['sex', 'age'], export_threshold=export_threshold)
+    assert any(url.endswith('/export/data') for url in client.requested) == from_export
+    assert any('/data-points/' in url for url in client.requested) != from_export
+    assert list(df.index) == ['R3', 'R1', 'R2']
+    assert list(df.columns) == ['sex', 'age']
+    assert list(df['age']) == [45.0, 61.5, 70.0]
+    assert df['age'].dtype == float
+    assert df['sex'].isna().tolist() == [True, False, False]
+    assert list(df['sex'][1:]) == [1, 2]
+
+
+def test_get_field_values_raises_on_rate_limit():
+    routes = create_routes()
+    routes['/study/S/participant/R2/data-points/study'] = (429, {'detail': 'Too many requests'})
+    client = StubApiClient(routes)
+    with pytest.raises(requests.HTTPError):
+        client.get_field_values('S', ['R1', 'R2', 'R3'], ['age'])
+
+
+def test_get_study_data_streams_export():
+    client = StubApiClient(create_routes())
+    data = client.get_study_data('S', fields=['sex'])
+    assert client.streamed == [client.api_url + '/study/S/export/data']
+    assert list(data.keys()) == ['record_id', 'sex']
+    assert data['record_id']['field_values'] == ['R1', 'R2', 'R3']
+    assert data['sex']['field_values'] == ['1', '2', '']
@@ -0,0 +1,137 @@
+import asyncio
+import pytest
+
+aiohttp = pytest.importorskip('aiohttp')
+
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+from barbell2_castor.asyncapi import AsyncCastorApiClient
+from barbell2_castor.schema import StudySchemaPlan
+from tests.conftest import FIELDS, OPTION_GROUPS, create_structure_export, create_optiongroups_export
+
+
+DATA_LINES = [
+    'S;R1;;;;;;;',
+    'S;R1;Study;x;x;F1;61.5;x;x',
+    'S;R1;Study;x;x;F2;1;x;x',
+    'S;R2;;;;;;;',
+    'S;R2;Study;x;x;F1;first\rsecond\u2028third;x;x',
+]
+
+
+class StubCastorServer:
+
+    # Local stand-in for Castor with paged records, tokens that can be revoked and a
+    # count of concurrent requests
+
+    page_count = 3
+
+    def __init__(self):
+        self.nr_tokens = 0
+        self.revoked = set()
+        self.nr_active = 0
+        self.max_active = 0
+        self.app = web.Application()
+        self.app.router.add_post('/oauth/token', self.token)
+        self.app.router.add_get('/api/study', self.studies)
+        self.app.router.add_get('/api/study/S/record', self.records)
+        self.app.router.add_get('/api/study/S/export/{name}', self.export)
+        self.server = TestServer(self.app)
+
+    def get_base_url(self):
+        return str(self.server.make_url('')).rstrip('/')
+
+    async def token(self, request):
+        self.nr_tokens += 1
+        return web.json_response({'access_token': f'token{self.nr_tokens}', 'expires_in': 3600})
+
+    async def check(self, request):
+        self.nr_active += 1
+        self.max_active = max(self.max_active, self.nr_active)
+        try:
+            await asyncio.sleep(0.01)
+        finally:
+            self.nr_active -= 1
+        token = request.headers.get('Authorization', '')[len('Bearer '):]
+        if token in self.revoked or not token.startswith('token'):
+            raise web.HTTPUnauthorized()
+
+    async def studies(self, request):
+        await self.check(request)
+        return web.json_response({'_embedded': {'study': [{'name': 'Test', 'study_id': 'S'}]}})
+
+    async def records(self, request):
+        await self.check(request)
+        page = int(request.query.get('page', 1))
+        records = [{'id': f'P{page}-{i}'} for i in range(3)] + [{'id': f'ARCHIVED-P{page}'}]
+        return web.json_response({'page_count': self.page_count, '_embedded': {'records': records}})
+
+    async def export(self, request):
+        await self.check(request)
+        name = request.match_info['name']
+        if name == 'structure':
+            return web.Response(text=create_structure_export(FIELDS))
+        if name == 'optiongroups':
+            return web.Response(text=create_optiongroups_export(OPTION_GROUPS))
+        return web.Response(text='\n'.join(['header'] + DATA_LINES))
+
+
+def run(test):
+    async def main():
+        server = StubCastorServer()
+        await server.server.start_server()
+        try:
+            await test(server)
+        finally:
+            await server.server.close()
+    asyncio.run(main())
+
+
+def test_get_records_reads_all_pages():
+    async def test(server):
+        async with AsyncCastorApiClient('id', 'secret', base_url=server.get_base_url()) as client:
+            records = await client.get_records('S')
+        assert [record['id'] for record in records] == [f'P{page}-{i}' for page in range(1, 4) for i in range(3)]
+    run(test)
+
+
+def test_rejected_token_is_refreshed_once():
+    async def test(server):
+        async with AsyncCastorApiClient('id', 'secret', base_url=server.get_base_url()) as client:
+            assert server.nr_tokens == 1
+            server.revoked.add('token1')
+            async def get_studies(delay):
+                # Later requests still send token1 but are rejected after it was replaced
+                await asyncio.sleep(delay)
+                return await client.get(client.api_url + '/study')
+            await asyncio.gather(*[get_studies(i * 0.005) for i in range(8)])
+            assert server.nr_tokens == 2
+            assert client.access_token == 'token2'
+    run(test)
+
+
+def test_shared_semaphore_limits_concurrency():
+    async def test(server):
+        semaphore = asyncio.Semaphore(2)
+        clients = [AsyncCastorApiClient('id', 'secret', base_url=server.get_base_url(), semaphore=semaphore) for _ in range(2)]
+        for client in clients:
+            await client.open()
+        try:
+            server.max_active = 0
+            await asyncio.gather(*[client.get_records('S') for client in clients for _ in range(4)])
+            assert server.max_active == 2
+        finally:
+            for client in clients:
+                await client.close()
+    run(test)
+
+
+def test_get_study_data_matches_sync_build():
+    async def test(server):
+        async with AsyncCastorApiClient('id', 'secret', base_url=server.get_base_url(), cache_dir=False) as client:
+            data = await client.get_study_data('S')
+        plan = StudySchemaPlan.from_exports(
+            create_structure_export(FIELDS), create_optiongroups_export(OPTION_GROUPS), cache_dir=False)
+        assert data == plan.build_study_data(DATA_LINES)
+        assert data['age']['field_values'] == ['61.5', 'first\rsecond\u2028third']
+    run(test)
@@ -0,0 +1,49 @@
+import sqlite3
+
+from datetime import datetime
+
+from barbell2_castor.castor2sqlite import DictToSqlite3
+from barbell2_castor.history import ExportHistory
+from barbell2_castor.query import CastorQueryRunner
+from barbell2_castor.schema import StudySchemaPlan
+from tests.conftest import FIELDS, OPTION_GROUPS, create_lines
+
+
+def export(plan, lines, db_file, history_file):
+    DictToSqlite3(plan.build_study_data(lines), db_file, plan=plan, history=history_file).execute()
+
+
+def test_history_stores_record_level_deltas(tmp_path):
+    plan = StudySchemaPlan('test', FIELDS, OPTION_GROUPS)
+    history_file = str(tmp_path / 'history.db')
+    export(plan, create_lines(range(100)), str(tmp_path / 'v1.db'), history_file)
+    export(plan, create_lines(range(1, 100), changed=50), str(tmp_path / 'v2.db'), history_file)
+    history = ExportHistory(history_file)
+    try:
+        assert history.db.execute('SELECT COUNT(*) FROM changes WHERE version_id = 2;').fetchone()[0] == 2
+        assert history.diff(1, 2) == {'added': [], 'removed': ['R0'], 'changed': ['R50']}
+        conn = sqlite3.connect(':memory:')
+        history.restore(conn, version_id=1)
+        assert conn.execute('SELECT COUNT(*) FROM data;').fetchone()[0] == 100
+    finally:
+        history.close()
+    runner = CastorQueryRunner.from_history(history_file)
+    output = runner.execute("SELECT age FROM data WHERE record_id = 'R50';")
+    assert output['age'][0] == 150.5
+
+
+def test_versions_by_timestamp(tmp_path):
+    plan = StudySchemaPlan('test', FIELDS, OPTION_GROUPS)
+    history = ExportHistory(str(tmp_path / 'history.db'))
+    try:
+        for i, hour in enumerate([10, 12]):
+            db_file = str(tmp_path / f'v{i}.db')
+            DictToSqlite3(plan.build_study_data(create_lines(range(i + 1))), db_file, plan=plan).execute()
+            history.add_database(db_file, exported_at=datetime(2024, 1, 1, hour))
+        assert history.get_version_id('2024-01-01T10:00:00') == 1
+        assert history.get_version_id('2024-01-01T11:59') == 1
+        assert history.get_version_id('2024-01-01 12:00:00') == 2
+        assert history.get_version_id('2024-01-01') == 2
+        assert history.get_version_id(datetime(2024, 1, 1, 10, 30)) == 1
+    finally:
+        history.close()
@@ -0,0 +1,85 @@
+import pytest
+
+from barbell2_castor.castor2sqlite import DictToSqlite3
+from barbell2_castor.query import CastorQueryRunner
+from barbell2_castor.schema import StudySchemaPlan
+from tests.conftest import FIELDS, OPTION_GROUPS
+
+
+CONFIG = {
+    'cohorts': {'male': 'sex = 1'},
+    'aggregates': {
+        'per_sex': {'group_by': {'sex': 'sex'}},
+        'male_per_year': {'cohort': 'male', 'group_by': {'year': "strftime('%Y', dat)"}},
+    },
+}
+
+
+def create_db(db_file, materialize=CONFIG):
+    plan = StudySchemaPlan('test', FIELDS, OPTION_GROUPS)
+    lines = []
+    for i in range(40):
+        lines.append(f'S;R{i};;;;;;;')
+        lines.append(f'S;R{i};Study;x;x;F1;{i}.5;x;x')
+        lines.append(f'S;R{i};Study;x;x;F2;{i % 3 % 2 + 1};x;x')
+        lines.append(f'S;R{i};Study;x;x;F3;01-01-{2018 + i % 4};x;x')
+    return DictToSqlite3(plan.build_study_data(lines), db_file, plan=plan, materialize=materialize).execute()
+
+
+def get_table_names(runner):
+    rows = runner.db.execute("SELECT name FROM sqlite_master WHERE type = 'table' ORDER BY name;").fetchall()
+    return [row[0] for row in rows]
+
+
+def assert_same_output(db_file, query, rewritten_query):
+    runner = CastorQueryRunner(db_file)
+    assert runner.rewriter.rewrite(query) == rewritten_query
+    expected = CastorQueryRunner(db_file, use_materialized=False).execute(query)
+    output = runner.execute(query)
+    assert list(output.columns) == list(expected.columns)
+    assert output.values.tolist() == expected.values.tolist()
+
+
+def test_materialized_tables(tmp_path):
+    runner = CastorQueryRunner(create_db(str(tmp_path / 'castor.db')))
+    assert get_table_names(runner) == ['agg_male_per_year', 'agg_per_sex', 'cohort_male', 'column_stats', 'data', 'materialized_views']
+    assert runner.execute('SELECT COUNT(*) AS n FROM cohort_male;')['n'][0] == 27
+    assert runner.execute('SELECT * FROM agg_per_sex ORDER BY sex;').values.tolist() == [[1, 27], [2, 13]]
+
+
+def test_cohort_rewrite_keeps_query_text(tmp_path):
+    db_file = create_db(str(tmp_path / 'castor.db'))
+    assert_same_output(
+        db_file, "SELECT record_id,  'x  y' AS lit FROM data\n WHERE sex = 1;",
+        "SELECT record_id,  'x  y' AS lit FROM cohort_male;")
+
+
+@pytest.mark.parametrize('query, rewritten_query', [
+    ('SELECT sex, COUNT(*) FROM data GROUP BY sex', 'SELECT sex, count AS "COUNT(*)" FROM agg_per_sex;'),
+    ('select sex as s, count( * ) as n from data group by sex;', 'SELECT sex AS s, count AS n FROM agg_per_sex;'),
+    ('SELECT COUNT(*) AS count, sex FROM data GROUP BY sex', 'SELECT count, sex FROM agg_per_sex;'),
+    ("SELECT strftime('%Y', dat), COUNT(*) FROM data WHERE sex = 1 GROUP BY strftime('%Y', dat)",
+        'SELECT year AS "strftime(\'%Y\', dat)", count AS "COUNT(*)" FROM agg_male_per_year;'),
+])
+def test_aggregate_rewrite(tmp_path, query, rewritten_query):
+    assert_same_output(create_db(str(tmp_path / 'castor.db')), query, rewritten_query)
+
+
+@pytest.mark.parametrize('query', [
+    'SELECT sex, COUNT(*) FROM data WHERE sex = 2 GROUP BY sex',
+    'SELECT sex, MAX(age) FROM data GROUP BY sex',
+    'SELECT sex, COUNT(*) FROM data GROUP BY sex ORDER BY sex DESC',
+    "SELECT * FROM data WHERE sex = 1 AND dat > '2019-01-01'",
+    "SELECT * FROM data WHERE remarks = 'sex = 1'",
+])
+def test_no_rewrite(tmp_path, query):
+    runner = CastorQueryRunner(create_db(str(tmp_path / 'castor.db')))
+    assert runner.rewriter.rewrite(query) == query
+
+
+def test_reexport_invalidates_materialized_tables(tmp_path):
+    db_file = create_db(str(tmp_path / 'castor.db'))
+    create_db(db_file, materialize=None)
+    runner = CastorQueryRunner(db_file)
+    assert get_table_names(runner) == ['column_stats', 'data']
+    assert runner.rewriter.rewrite('SELECT * FROM data WHERE sex = 1;') == 'SELECT * FROM data WHERE sex = 1;'
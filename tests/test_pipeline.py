@@ -0,0 +1,80 @@
+import os
+import sqlite3
+import pytest
+
+from barbell2_castor.castor2sqlite import DictToSqlite3
+from barbell2_castor.pipeline import StudyDataPipeline
+from barbell2_castor.schema import StudySchemaPlan
+from tests.conftest import FIELDS, OPTION_GROUPS, StubApiClient, create_lines
+
+
+class StubClient:
+
+    def __init__(self, lines, fail_after=None):
+        self.lines = lines
+        self.fail_after = fail_after
+
+    def iter_study_data_lines(self, study_id):
+        for i in range(len(self.lines)):
+            if self.fail_after is not None and i == self.fail_after:
+                raise IOError('connection lost')
+            yield self.lines[i]
+
+
+def read_rows(db_file, table='data'):
+    conn = sqlite3.connect(db_file)
+    try:
+        return conn.execute(f'SELECT * FROM {table} ORDER BY 1;').fetchall()
+    finally:
+        conn.close()
+
+
+def test_pipelined_output_matches_dict_to_sqlite3(tmp_path):
+    plan = StudySchemaPlan('test', FIELDS, OPTION_GROUPS)
+    lines = create_lines(range(1234))
+    pipelined_db = str(tmp_path / 'pipelined.db')
+    StudyDataPipeline(StubClient(lines), 'S', plan, pipelined_db, batch_size=100, queue_size=2).execute()
+    dict_db = str(tmp_path / 'dict.db')
+    DictToSqlite3(plan.build_study_data(lines), dict_db, plan=plan).execute()
+    assert len(read_rows(pipelined_db)) == 1234
+    assert read_rows(pipelined_db) == read_rows(dict_db)
+    assert read_rows(pipelined_db, 'column_stats') == read_rows(dict_db, 'column_stats')
+
+
+def test_failing_stage_raises(tmp_path):
+    plan = StudySchemaPlan('test', FIELDS, OPTION_GROUPS)
+    db_file = str(tmp_path / 'x.db')
+    StudyDataPipeline(StubClient(create_lines(range(1000))), 'S', plan, db_file, batch_size=10).execute()
+    rows = read_rows(db_file)
+    column_stats = read_rows(db_file, 'column_stats')
+    with open(db_file + '.stats.json', 'r') as f:
+        stats_json = f.read()
+    pipeline = StudyDataPipeline(StubClient(create_lines(range(1000)), fail_after=500), 'S', plan, db_file, batch_size=10)
+    with pytest.raises(IOError):
+        pipeline.execute()
+    assert read_rows(db_file) == rows
+    assert read_rows(db_file, 'column_stats') == column_stats
+    with open(db_file + '.stats.json', 'r') as f:
+        assert f.read() == stats_json
+    assert sorted(os.listdir(str(tmp_path))) == ['x.db', 'x.db.stats.json']
+
+
+def test_line_separators_in_values(tmp_path):
+    # Only \n separates the lines of export/data, other line breaks are part of a value
+    plan = StudySchemaPlan('test', FIELDS, OPTION_GROUPS)
+    lines = create_lines(range(10))
+    lines[4] = 'S;R0;Study;x;x;F4;first\rsecond\u2028third\x1cfourth\x85;x;x'
+    client = StubApiClient({'/study/S/export/data': '\n'.join(['header'] + lines)})
+    pipelined_db = str(tmp_path / 'pipelined.db')
+    StudyDataPipeline(client, 'S', plan, pipelined_db).execute()
+    dict_db = str(tmp_path / 'dict.db')
+    DictToSqlite3(plan.build_study_data(lines), dict_db, plan=plan).execute()
+    assert read_rows(pipelined_db) == read_rows(dict_db)
+    assert read_rows(pipelined_db)[0][-1] == 'first\rsecond\u2028third\x1cfourth\x85'
+
+
+def test_ungrouped_export_raises(tmp_path):
+    plan = StudySchemaPlan('test', FIELDS, OPTION_GROUPS)
+    lines = create_lines(range(10)) + ['S;R3;Study;x;x;F1;1.0;x;x']
+    with pytest.raises(RuntimeError):
+        StudyDataPipeline(StubClient(lines), 'S', plan, str(tmp_path / 'x.db')).execute()
@@ -0,0 +1,85 @@
+import os
+import json
+import pytest
+
+from barbell2_castor.castor2sqlite import DictToSqlite3
+from barbell2_castor.schema import StudySchemaPlan
+from tests.conftest import FIELDS, OPTION_GROUPS, StubApiClient, create_structure_export, create_optiongroups_export
+
+
+def create_plan(option_groups=OPTION_GROUPS, cache_dir=None):
+    return StudySchemaPlan.from_exports(
+        create_structure_export(FIELDS), create_optiongroups_export(option_groups), cache_dir)
+
+
+def test_cached_plan_is_reused(schema_cache_dir):
+    plan = create_plan()
+    cache_file = StudySchemaPlan.get_cache_file(plan.key)
+    assert os.listdir(schema_cache_dir) == [os.path.basename(cache_file)]
+    with open(cache_file, 'r') as f:
+        cached = json.load(f)
+    cached['fields'][0]['field_name'] = 'cached_age'
+    with open(cache_file, 'w') as f:
+        json.dump(cached, f)
+    assert create_plan().field_names == ['cached_age', 'sex', 'dat', 'remarks']
+
+
+def test_option_group_change_rebuilds_plan(schema_cache_dir):
+    plan = create_plan()
+    changed_plan = create_plan({'OG1': {'1': 'Male', '2': 'Female', '3': 'Other'}})
+    assert changed_plan.key != plan.key
+    assert changed_plan.field_options['sex'] == {'1': 'Male', '2': 'Female', '3': 'Other'}
+    assert len(os.listdir(schema_cache_dir)) == 2
+
+
+def test_corrupt_cached_plan_is_rebuilt():
+    plan = create_plan()
+    cache_file = StudySchemaPlan.get_cache_file(plan.key)
+    with open(cache_file, 'w') as f:
+        f.write('{"key": ')
+    assert create_plan().field_names == plan.field_names
+    assert StudySchemaPlan.load(plan.key).field_names == plan.field_names
+
+
+def test_cache_can_be_disabled(schema_cache_dir):
+    create_plan(cache_dir=False)
+    routes = {
+        '/study/S/export/structure': create_structure_export(FIELDS),
+        '/study/S/export/optiongroups': create_optiongroups_export(OPTION_GROUPS),
+    }
+    StubApiClient(routes).get_study_schema_plan('S')
+    assert len(os.listdir(schema_cache_dir)) == 1
+    client = StubApiClient(routes)
+    client.cache_dir = False
+    client.get_study_schema_plan('S')
+    assert len(os.listdir(schema_cache_dir)) == 1
+
+
+def test_least_recently_used_plans_are_pruned(schema_cache_dir, monkeypatch):
+    monkeypatch.setattr(StudySchemaPlan, 'max_cached_plans', 3)
+    keys = []
+    for i in range(3):
+        keys.append(create_plan({'OG1': {'1': f'Option {i}'}}).key)
+        os.utime(StudySchemaPlan.get_cache_file(keys[-1]), (1000 + i, 1000 + i))
+    # Using the oldest plan again makes the second one the least recently used
+    StudySchemaPlan.load(keys[0])
+    create_plan({'OG1': {'1': 'Option 3'}})
+    assert StudySchemaPlan.load(keys[0]) is not None
+    assert StudySchemaPlan.load(keys[1]) is None
+    assert len(os.listdir(schema_cache_dir)) == 3
+
+
+def test_cached_plan_by_key(tmp_path):
+    plan = create_plan()
+    data = plan.build_study_data(['S;R1;;;;;;;', 'S;R1;Study;x;x;F2;2;x;x'])
+    db_file = DictToSqlite3(data, str(tmp_path / 'castor.db'), plan=plan.key).execute()
+    assert os.path.isfile(db_file)
+    with pytest.raises(RuntimeError):
+        StudySchemaPlan.create('unknown')
+
+
+def test_record_id_variable_is_rejected():
+    fields = FIELDS + [dict(FIELDS[0], field_id='F5', field_name='record_id')]
+    plan = StudySchemaPlan.from_exports(create_structure_export(fields), create_optiongroups_export(OPTION_GROUPS))
+    with pytest.raises(RuntimeError):
+        plan.build_study_data(['S;R1;;;;;;;'])
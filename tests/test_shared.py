@@ -0,0 +1,52 @@
+import json
+import pandas as pd
+
+from barbell2_castor.shared import SharedStudyDataset
+
+
+def test_republish_keeps_attached_dataset_valid(tmp_path):
+    path = str(tmp_path / 'dataset')
+    SharedStudyDataset.publish(pd.DataFrame({'age': [1.5, 2.5, 3.5], 'sex': ['M', 'F', 'M']}), path)
+    attached = SharedStudyDataset.attach(path)
+    SharedStudyDataset.publish(pd.DataFrame({'age': [10.5], 'sex': ['F']}), path)
+    assert list(attached['age']) == [1.5, 2.5, 3.5]
+    assert list(attached['sex']) == ['M', 'F', 'M']
+    republished = SharedStudyDataset.attach(path)
+    assert list(republished['age']) == [10.5]
+    assert len(list(tmp_path.glob('dataset.*'))) == 2  # manifest and the latest data file
+
+
+def test_publish_merges_values_with_the_same_string(tmp_path):
+    path = str(tmp_path / 'dataset')
+    SharedStudyDataset.publish(pd.DataFrame({'code': [1, '1', 'a', None]}), path)
+    df = SharedStudyDataset.attach(path)
+    assert list(df['code'].cat.categories) == ['1', 'a']
+    assert list(df['code'].astype(object).where(df['code'].notna(), None)) == ['1', '1', 'a', None]
+
+
+def test_publish_nullable_columns(tmp_path):
+    path = str(tmp_path / 'dataset')
+    df = pd.DataFrame({
+        'flag': pd.array([True, None, False], dtype='boolean'),
+        'count': pd.array([1, None, 3], dtype='Int64'),
+        'total': pd.array([1, 2, 3], dtype='Int64'),
+    })
+    SharedStudyDataset.publish(df, path)
+    df = SharedStudyDataset.attach(path)
+    assert df['flag'].isna().tolist() == [False, True, False]
+    assert list(df['flag'][[0, 2]]) == [1.0, 0.0]
+    assert list(df['count'].fillna(-1)) == [1.0, -1.0, 3.0]
+    assert list(df['total']) == [1, 2, 3]
+
+
+def test_publish_numbers_read_as_strings(tmp_path):
+    path = str(tmp_path / 'dataset')
+    df = pd.DataFrame({'age': ['61.5', '', '70'], 'sex': ['1', '2', None], 'name': ['a', 'b', '3']}, dtype=str)
+    SharedStudyDataset.publish(df, path)
+    with open(SharedStudyDataset.get_manifest_file(path), 'r') as f:
+        manifest = json.load(f)
+    assert [column['kind'] for column in manifest['columns']] == ['values', 'values', 'categorical']
+    df = SharedStudyDataset.attach(path)
+    assert list(df['age'].fillna(-1)) == [61.5, -1.0, 70.0]
+    assert list(df['sex'].fillna(-1)) == [1.0, 2.0, -1.0]
+    assert list(df['name']) == ['a', 'b', '3']